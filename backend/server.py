@@ -1,35 +1,357 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Header, Query, Request
+from fastapi.responses import StreamingResponse, Response
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError
+from bson import json_util
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import aiofiles
 import mimetypes
 from mutagen import File as MutagenFile
 from mutagen.id3 import ID3NoHeaderError
 import base64
 import io
+import hashlib
+import json
+import mmap
+import shutil
+import struct
+import subprocess
+import wave
+import numpy as np
+import time
+import zlib
+import asyncio
+import anyio
+import unicodedata
+import heapq
+import bisect
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from PIL import Image
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+class Metric:
+    """Base for a labelled metric family rendered in Prometheus text format"""
+
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def format_labels(self, labels: tuple, extra: str = "") -> str:
+        pairs = [
+            '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in zip(self.labelnames, labels)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            yield f"{self.name}{self.format_labels(labels)} {value}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, *labels) -> None:
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, *labels) -> None:
+        self.inc(-amount, *labels)
+
+    def set(self, value: float, *labels) -> None:
+        with self.lock:
+            self.values[labels] = value
+
+
+class Histogram(Metric):
+    """Cumulative-bucket histogram; observe() is a bisect plus two additions"""
+
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # Per-bucket counts (non-cumulative) plus +Inf, then sum
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            items = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                yield f"{self.name}_bucket{self.format_labels(labels, le)} {cumulative}"
+            yield f"{self.name}_sum{self.format_labels(labels)} {total}"
+            yield f"{self.name}_count{self.format_labels(labels)} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+metrics = MetricsRegistry()
+http_requests_in_flight = metrics.register(Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served"))
+http_requests_total = metrics.register(Counter(
+    "http_requests_total", "HTTP requests served", ("method", "route", "status")))
+http_request_duration = metrics.register(Histogram(
+    "http_request_duration_seconds", "Time from request start until the response body completed",
+    ("method", "route")))
+stream_bytes_sent = metrics.register(Counter(
+    "stream_bytes_sent_total", "Audio bytes sent by file responses", ("mode",)))
+upload_bytes_received = metrics.register(Counter(
+    "upload_bytes_received_total", "Bytes received from song uploads"))
+audio_cache_requests = metrics.register(Counter(
+    "audio_cache_requests_total", "Audio block cache lookups", ("result",)))
+audio_cache_bytes = metrics.register(Gauge(
+    "audio_cache_bytes", "Bytes of audio held in the block cache"))
+prefetch_bytes_warmed = metrics.register(Counter(
+    "prefetch_bytes_warmed_total", "Bytes read ahead into the page cache for upcoming tracks"))
+metadata_extract_duration = metrics.register(Histogram(
+    "metadata_extract_duration_seconds", "Time spent extracting metadata, including pool queueing",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)))
+mongo_command_duration = metrics.register(Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency as seen by the driver",
+    ("collection", "command", "outcome")))
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """pymongo command listener feeding mongo_command_duration"""
+
+    def __init__(self):
+        self.pending = {}
+
+    def started(self, event) -> None:
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self.pending[(event.connection_id, event.request_id)] = collection
+
+    def finish(self, event, outcome: str) -> None:
+        collection = self.pending.pop((event.connection_id, event.request_id), "")
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection, event.command_name, outcome)
+
+    def succeeded(self, event) -> None:
+        self.finish(event, "success")
+
+    def failed(self, event) -> None:
+        self.finish(event, "failure")
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts, latency and in-flight requests
+
+    Latency is labelled by the matched route template rather than the raw
+    path so per-song URLs collapse into one series.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc(1)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_requests_in_flight.dec(1)
+            # The router stores the matched route in the shared scope
+            route = scope.get("route")
+            route_path = getattr(route, "path", None) or "unmatched"
+            method = scope.get("method", "")
+            http_request_duration.observe(time.perf_counter() - start, method, route_path)
+            http_requests_total.inc(1, method, route_path, status)
+
+
 # MongoDB connection
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(mongo_url, event_listeners=[MongoCommandTimer()])
 db = client[os.environ['DB_NAME']]
 
 # Create upload directory
 UPLOAD_DIR = ROOT_DIR / "uploads"
 UPLOAD_DIR.mkdir(exist_ok=True)
 
+# Album art thumbnails, keyed by the hash of the embedded image
+ARTWORK_DIR = ROOT_DIR / "artwork"
+ARTWORK_DIR.mkdir(exist_ok=True)
+ARTWORK_SIZES = (64, 256, 512)
+ARTWORK_CACHE_BYTES = int(os.environ.get('ARTWORK_CACHE_BYTES', 32 * 1024 * 1024))
+
+# Per-track analysis artifacts (seek indexes), keyed by content hash
+INDEX_DIR = ROOT_DIR / "indexes"
+INDEX_DIR.mkdir(exist_ok=True)
+SEEK_INDEX_INTERVAL = 0.5
+
+# Waveform peak pyramids: level 0 holds one min/max pair per base bucket of
+# samples, each further level halves the resolution
+WAVEFORM_BASE_BUCKET = 256
+WAVEFORM_MIN_LEVEL_SIZE = 512
+MAX_WAVEFORM_BUCKETS = 8192
+PCM_BLOCK_FRAMES = 65536
+
+# Audio feature vectors for similarity: RMS loudness, spectral centroid,
+# tempo and duration bucket
+FEATURE_DIMENSIONS = 4
+FEATURE_FFT_SIZE = 2048
+FEATURE_HOP_SIZE = 512
+
+# ReplayGain 2.0 style loudness normalization (ITU-R BS.1770 gating)
+REPLAYGAIN_REFERENCE_LUFS = -18.0
+LOUDNESS_SUBBLOCK_SECONDS = 0.1
+LOUDNESS_ABSOLUTE_GATE = -70.0
+LOUDNESS_RELATIVE_GATE = -10.0
+
+# Server-side 10-band equalizer matching the client's bands; rendered
+# streams are cached on disk per (track, band gains) up to a byte budget
+EQ_FREQUENCIES = (31, 62, 125, 250, 500, 1000, 2000, 4000, 8000, 16000)
+EQ_Q = 1.41
+EQ_FIR_TAPS = 8192
+EQ_CACHE_BYTES = int(os.environ.get('EQ_CACHE_BYTES', 1024 * 1024 * 1024))
+
+# Streaming settings
+STREAM_CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 16
+
+# Hot audio is cached in memory as fixed-size blocks; 0 disables the cache
+AUDIO_CACHE_BYTES = int(os.environ.get('AUDIO_CACHE_BYTES', 128 * 1024 * 1024))
+AUDIO_CACHE_BLOCK_SIZE = int(os.environ.get('AUDIO_CACHE_BLOCK_SIZE', 256 * 1024))
+
+# Next-track prefetch: upcoming files are advised into the page cache and
+# their first bytes read ahead so track transitions start warm
+PREFETCH_TRACKS = int(os.environ.get('PREFETCH_TRACKS', 3))
+PREFETCH_HEAD_BYTES = int(os.environ.get('PREFETCH_HEAD_BYTES', 2 * 1024 * 1024))
+PREFETCH_WORKERS = int(os.environ.get('PREFETCH_WORKERS', 2))
+PREFETCH_TTL = float(os.environ.get('PREFETCH_TTL', 60))
+
+# Upload settings
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_SIZE = int(os.environ.get('MAX_UPLOAD_SIZE', 1024 * 1024 * 1024))
+MAX_UPLOAD_FILES = 1000
+# Room for multipart boundaries and part headers around a single upload
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Resumable uploads: sessions idle for longer than the TTL are discarded
+UPLOAD_SESSION_TTL = timedelta(seconds=float(os.environ.get('UPLOAD_SESSION_TTL', 24 * 3600)))
+UPLOAD_SESSION_SWEEP_INTERVAL = 600
+
+# Play counting: plays are buffered in memory and flushed in batches
+PLAY_FLUSH_INTERVAL = float(os.environ.get('PLAY_FLUSH_INTERVAL', 5))
+PLAY_DEDUP_WINDOW = float(os.environ.get('PLAY_DEDUP_WINDOW', 30))
+
+# Play history analytics
+ANALYTICS_DEFAULT_WINDOW = timedelta(days=7)
+MAX_ANALYTICS_DAYS = 366
+
+# Change events pushed to clients over Server-Sent Events
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', 256))
+EVENT_HISTORY_SIZE = 1024
+EVENT_KEEPALIVE_INTERVAL = 15.0
+
+# Library statistics snapshot
+STATS_REFRESH_INTERVAL = float(os.environ.get('STATS_REFRESH_INTERVAL', 600))
+RECENT_PLAYS_WINDOW = timedelta(days=7)
+MOST_PLAYED_LIMIT = 10
+
+# In-place library import from existing directories (os.pathsep separated)
+LIBRARY_DIRS = [Path(path) for path in os.environ.get('LIBRARY_DIRS', '').split(os.pathsep) if path]
+AUDIO_EXTENSIONS = {".mp3", ".flac", ".ogg", ".oga", ".opus", ".m4a", ".mp4", ".aac", ".wav", ".aif", ".aiff", ".wma"}
+SCAN_BATCH_SIZE = 500
+
+# Song listing
+SONG_SORT_FIELDS = ("date_added", "title", "artist", "album", "duration", "play_count", "last_played")
+CATALOG_TEXT_FIELDS = ("title", "artist", "album")
+CATALOG_TIME_FIELDS = ("date_added", "last_played")
+# Changes to more rows than this drop a cached sort order instead of repairing it
+CATALOG_REPAIR_ROWS = 1024
+MAX_PAGE_SIZE = 1000
+
+# Metadata extraction runs in a bounded process pool, off the event loop
+METADATA_WORKERS = int(os.environ.get('METADATA_WORKERS', min(4, os.cpu_count() or 1)))
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', 8))
+metadata_executor: Optional[ProcessPoolExecutor] = None
+
+# Full-file decodes (waveforms, features, loudness) get their own lower-priority
+# pool so that ingest extraction never queues behind them
+ANALYSIS_WORKERS = int(os.environ.get('ANALYSIS_WORKERS', max(1, METADATA_WORKERS // 2)))
+ANALYSIS_NICENESS = 10
+analysis_executor: Optional[ProcessPoolExecutor] = None
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -47,6 +369,15 @@ class Song(BaseModel):
     file_path: str
     file_size: int = 0
     mime_type: str = ""
+    content_hash: str = ""
+    source: str = "upload"  # upload or library
+    file_mtime: Optional[float] = None
+    version: int = 0
+    artwork_id: Optional[str] = None
+    track_gain: Optional[float] = None
+    track_peak: Optional[float] = None
+    album_gain: Optional[float] = None
+    album_peak: Optional[float] = None
     play_count: int = 0
     is_favorite: bool = False
     date_added: datetime = Field(default_factory=datetime.utcnow)
@@ -69,6 +400,18 @@ class PlaylistCreate(BaseModel):
     name: str
     description: str = ""
 
+class PlaylistSongsUpdate(BaseModel):
+    song_ids: List[str]
+    position: Optional[int] = None
+
+class QueueUpdate(BaseModel):
+    song_ids: List[str]
+
+class UploadSessionCreate(BaseModel):
+    filename: str
+    content_type: str
+    length: int = Field(gt=0)
+
 class UserSettings(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     theme: str = "dark"  # dark or light
@@ -104,15 +447,20 @@ def extract_metadata(file_path: str) -> dict:
         metadata['album'] = str(tags.get('TALB', [''])[0]) if 'TALB' in tags else \
                            str(tags.get('ALBUM', [''])[0]) if 'ALBUM' in tags else ""
         
-        # Get album art
+        # Get album art (raw bytes; see extract_file_metadata)
         album_art = None
-        if 'APIC:' in tags:
-            album_art = tags['APIC:'].data
+        apic_keys = [key for key in tags.keys() if key.startswith('APIC')] if hasattr(tags, 'keys') else []
+        if apic_keys:
+            album_art = tags[apic_keys[0]].data
+        elif 'covr' in tags:
+            album_art = bytes(tags['covr'][0])
         elif 'ARTWORK' in tags:
             album_art = tags['ARTWORK'][0]
+        elif getattr(audio_file, 'pictures', None):
+            album_art = audio_file.pictures[0].data
         
         if album_art:
-            metadata['album_art'] = base64.b64encode(album_art).decode('utf-8')
+            metadata['album_art'] = album_art
         
         return metadata
     except Exception as e:
@@ -120,213 +468,3131 @@ def extract_metadata(file_path: str) -> dict:
         return {}
 
 
-# API Routes
-@api_router.get("/")
-async def root():
-    return {"message": "Music Player API"}
-
-@api_router.post("/songs/upload")
-async def upload_song(file: UploadFile = File(...)):
-    """Upload a music file"""
-    # Check file type
-    if not file.content_type.startswith('audio/'):
-        raise HTTPException(status_code=400, detail="File must be an audio file")
-    
-    # Generate unique filename
-    file_extension = Path(file.filename).suffix
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_path = UPLOAD_DIR / unique_filename
+def save_artwork(image_data: bytes) -> Optional[str]:
+    """Write pre-resized JPEG thumbnails for embedded artwork, returning its id"""
+    artwork_id = hashlib.sha256(image_data).hexdigest()
+    if all((ARTWORK_DIR / f"{artwork_id}_{size}.jpg").exists() for size in ARTWORK_SIZES):
+        return artwork_id
     
     try:
-        # Save file
-        async with aiofiles.open(file_path, 'wb') as f:
-            content = await file.read()
-            await f.write(content)
-        
-        # Extract metadata
-        metadata = extract_metadata(str(file_path))
-        
-        # Create song object
-        song_data = {
-            "title": metadata.get('title') or Path(file.filename).stem,
-            "artist": metadata.get('artist') or "Unknown Artist",
-            "album": metadata.get('album') or "Unknown Album",
-            "duration": metadata.get('duration', 0.0),
-            "file_path": str(file_path),
-            "file_size": len(content),
-            "mime_type": file.content_type
-        }
-        
-        song = Song(**song_data)
-        await db.songs.insert_one(song.dict())
-        
-        return song
+        image = Image.open(io.BytesIO(image_data))
+        image = image.convert("RGB")
     except Exception as e:
-        # Clean up file if error
-        if file_path.exists():
-            file_path.unlink()
-        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
+        logging.error(f"Error decoding artwork: {e}")
+        return None
+    
+    for size in ARTWORK_SIZES:
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size), Image.LANCZOS)
+        target = ARTWORK_DIR / f"{artwork_id}_{size}.jpg"
+        temp_path = ARTWORK_DIR / f".{uuid.uuid4()}.part"
+        thumbnail.save(temp_path, format="JPEG", quality=85, optimize=True)
+        os.replace(temp_path, target)
+    return artwork_id
 
-@api_router.get("/songs", response_model=List[Song])
-async def get_songs():
-    """Get all songs"""
-    songs = await db.songs.find().to_list(1000)
-    return [Song(**song) for song in songs]
 
-@api_router.get("/songs/{song_id}", response_model=Song)
-async def get_song(song_id: str):
-    """Get a specific song"""
-    song = await db.songs.find_one({"id": song_id})
-    if not song:
-        raise HTTPException(status_code=404, detail="Song not found")
-    return Song(**song)
+MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 2.5: (11025, 12000, 8000)}
 
-@api_router.get("/songs/{song_id}/stream")
-async def stream_song(song_id: str, range: str = None):
-    """Stream a song file"""
-    song = await db.songs.find_one({"id": song_id})
-    if not song:
-        raise HTTPException(status_code=404, detail="Song not found")
+
+def parse_mp3_frame_header(header: int) -> Optional[Tuple[int, float]]:
+    """Decode a 32-bit MPEG audio frame header into (frame_length, frame_duration)"""
+    if header >> 21 != 0x7FF:
+        return None
+    version = {0: 2.5, 2: 2, 3: 1}.get((header >> 19) & 3)
+    layer = {1: 3, 2: 2, 3: 1}.get((header >> 17) & 3)
+    bitrate_index = (header >> 12) & 0xF
+    sample_rate_index = (header >> 10) & 3
+    if version is None or layer is None or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
     
-    file_path = Path(song["file_path"])
-    if not file_path.exists():
-        raise HTTPException(status_code=404, detail="Song file not found")
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][sample_rate_index]
+    padding = (header >> 9) & 1
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384 / sample_rate
+    samples = 576 if layer == 3 and version != 1 else 1152
+    return samples // 8 * bitrate // sample_rate + padding, samples / sample_rate
+
+
+def build_mp3_seek_index(file_path: str, interval: float = SEEK_INDEX_INTERVAL) -> Optional[List[int]]:
+    """Walk the MPEG frames of a file, recording the frame offset every ``interval`` seconds
+
+    Entry i is the byte offset of the frame playing at time i * interval.
+    """
+    with open(file_path, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return None
+    with data:
+        size = len(data)
+        position = 0
+        # Skip an ID3v2 tag
+        if data[:3] == b"ID3" and size >= 10:
+            tag_size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+            position = 10 + tag_size + (10 if data[5] & 0x10 else 0)
+        
+        offsets = []
+        elapsed = 0.0
+        while position + 4 <= size:
+            frame = parse_mp3_frame_header(struct.unpack_from(">I", data, position)[0])
+            if frame is None or frame[0] <= 4:
+                # Lost sync: resume at the next candidate sync byte
+                position = data.find(b"\xff", position + 1)
+                if position < 0:
+                    break
+                continue
+            frame_length, frame_duration = frame
+            while len(offsets) * interval < elapsed + frame_duration:
+                offsets.append(position)
+            elapsed += frame_duration
+            position += frame_length
+    return offsets or None
+
+
+def save_seek_index(content_hash: str, offsets: List[int], interval: float = SEEK_INDEX_INTERVAL):
+    """Write a seek index as a float64 interval followed by uint64 offsets"""
+    target = INDEX_DIR / f"{content_hash}.seek"
+    temp_path = INDEX_DIR / f".{uuid.uuid4()}.part"
+    with open(temp_path, "wb") as f:
+        f.write(struct.pack(f"<d{len(offsets)}Q", interval, *offsets))
+    os.replace(temp_path, target)
+
+
+def extract_file_metadata(file_path: str, content_hash: Optional[str] = None) -> dict:
+    """Ingest-time analysis run in a worker process
+
+    Extracts tags and stores embedded artwork as thumbnails on disk, so only
+    a small artwork id (never the image itself) travels back to the caller.
+    MP3 files also get a frame seek index under INDEX_DIR.
+    """
+    metadata = extract_metadata(file_path)
+    album_art = metadata.pop('album_art', None)
+    if album_art:
+        metadata['artwork_id'] = save_artwork(album_art)
     
-    # Update play count and last played
-    await db.songs.update_one(
-        {"id": song_id},
-        {
-            "$inc": {"play_count": 1},
-            "$set": {"last_played": datetime.utcnow()}
-        }
-    )
+    if content_hash and Path(file_path).suffix.lower() in (".mp3", ".mp2", ".mpga"):
+        try:
+            offsets = build_mp3_seek_index(file_path)
+            if offsets:
+                save_seek_index(content_hash, offsets)
+                metadata['seekable'] = True
+        except Exception as e:
+            logging.error(f"Error building seek index: {e}")
+    return metadata
+
+
+def decode_pcm(file_path: str, block_frames: int = PCM_BLOCK_FRAMES) -> Optional[Tuple[int, int, Iterator[np.ndarray]]]:
+    """Decode an audio file to blocks of float32 samples shaped (frames, channels)
+
+    Returns (sample_rate, channels, blocks), or None when no decoder is
+    available. PCM WAV is read natively; other formats identified by mutagen
+    are decoded by ffmpeg when it is installed.
+    """
+    try:
+        wav = wave.open(file_path, "rb")
+    except (wave.Error, EOFError):
+        wav = None
     
-    file_size = file_path.stat().st_size
+    if wav is not None:
+        sample_rate, channels, width = wav.getframerate(), wav.getnchannels(), wav.getsampwidth()
+        
+        def wav_blocks():
+            with wav:
+                while True:
+                    frames = wav.readframes(block_frames)
+                    if not frames:
+                        break
+                    if width == 1:
+                        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128) / 128
+                    elif width == 3:
+                        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3)
+                        ints = (raw[:, 0].astype(np.int32) | (raw[:, 1].astype(np.int32) << 8)
+                                | (raw[:, 2].astype(np.int32) << 16))
+                        samples = np.where(ints >= 1 << 23, ints - (1 << 24), ints).astype(np.float32) / (1 << 23)
+                    else:
+                        dtype = {2: np.int16, 4: np.int32}[width]
+                        samples = np.frombuffer(frames, dtype=f"<{np.dtype(dtype).char}").astype(np.float32)
+                        samples /= float(np.iinfo(dtype).max) + 1
+                    yield samples.reshape(-1, channels)
+        
+        return sample_rate, channels, wav_blocks()
     
-    async def generate():
-        async with aiofiles.open(file_path, 'rb') as f:
+    ffmpeg = shutil.which("ffmpeg")
+    audio_file = MutagenFile(file_path)
+    if ffmpeg is None or audio_file is None or not hasattr(audio_file, "info"):
+        return None
+    sample_rate = getattr(audio_file.info, "sample_rate", 0) or 44100
+    channels = getattr(audio_file.info, "channels", 0) or 2
+    
+    def ffmpeg_blocks():
+        process = subprocess.Popen(
+            [ffmpeg, "-v", "error", "-i", file_path, "-f", "f32le", "-ac", str(channels), "-ar", str(sample_rate), "-"],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        try:
+            block_bytes = block_frames * channels * 4
             while True:
-                chunk = await f.read(8192)
-                if not chunk:
+                data = process.stdout.read(block_bytes)
+                if not data:
                     break
-                yield chunk
+                usable = len(data) - len(data) % (channels * 4)
+                yield np.frombuffer(data[:usable], dtype="<f4").reshape(-1, channels)
+        finally:
+            process.kill()
+            process.wait()
     
-    return StreamingResponse(
-        generate(),
-        media_type=song["mime_type"],
-        headers={
-            "Content-Length": str(file_size),
-            "Accept-Ranges": "bytes"
-        }
-    )
+    return sample_rate, channels, ffmpeg_blocks()
 
-@api_router.put("/songs/{song_id}/favorite")
-async def toggle_favorite(song_id: str):
-    """Toggle favorite status of a song"""
-    song = await db.songs.find_one({"id": song_id})
-    if not song:
-        raise HTTPException(status_code=404, detail="Song not found")
+
+def waveform_level_path(content_hash: str, level: int) -> Path:
+    return INDEX_DIR / f"{content_hash}.peaks{level}.npy"
+
+
+def compute_waveform(file_path: str, content_hash: str) -> bool:
+    """Compute and store a song's waveform peak pyramid; runs in a worker process"""
+    decoded = decode_pcm(file_path)
+    if decoded is None:
+        return False
+    _, _, blocks = decoded
     
-    new_favorite_status = not song.get("is_favorite", False)
-    await db.songs.update_one(
-        {"id": song_id},
-        {"$set": {"is_favorite": new_favorite_status}}
-    )
+    # Reduce each block to base-level min/max pairs, carrying the remainder over
+    peaks = []
+    carry = np.empty(0, dtype=np.float32)
+    for block in blocks:
+        mono = np.concatenate((carry, block.mean(axis=1)))
+        whole = len(mono) - len(mono) % WAVEFORM_BASE_BUCKET
+        buckets = mono[:whole].reshape(-1, WAVEFORM_BASE_BUCKET)
+        peaks.append(np.stack((buckets.min(axis=1), buckets.max(axis=1)), axis=1))
+        carry = mono[whole:]
+    if len(carry):
+        peaks.append(np.array([[carry.min(), carry.max()]], dtype=np.float32))
+    if not peaks:
+        return False
+    level = np.clip(np.concatenate(peaks) * 32767, -32767, 32767).astype(np.int16)
     
-    return {"is_favorite": new_favorite_status}
+    index = 0
+    while True:
+        temp_path = INDEX_DIR / f".{uuid.uuid4()}.npy"
+        np.save(temp_path, level)
+        os.replace(temp_path, waveform_level_path(content_hash, index))
+        if len(level) <= WAVEFORM_MIN_LEVEL_SIZE:
+            break
+        if len(level) % 2:
+            level = np.concatenate((level, level[-1:]))
+        pairs = level.reshape(-1, 2, 2)
+        level = np.stack((pairs[:, :, 0].min(axis=1), pairs[:, :, 1].max(axis=1)), axis=1)
+        index += 1
+    return True
 
-@api_router.get("/stats")
-async def get_stats():
-    """Get library statistics"""
-    total_songs = await db.songs.count_documents({})
-    favorites = await db.songs.count_documents({"is_favorite": True})
+
+def read_waveform(content_hash: str, buckets: int) -> Optional[np.ndarray]:
+    """Downsample the stored peak pyramid to ``buckets`` min/max pairs in [-1, 1]"""
+    # Pick the coarsest memory-mapped level that still has enough resolution
+    chosen = None
+    level = 0
+    while waveform_level_path(content_hash, level).exists():
+        peaks = np.load(waveform_level_path(content_hash, level), mmap_mode="r")
+        if chosen is not None and len(peaks) < buckets:
+            break
+        chosen = peaks
+        level += 1
+    if chosen is None:
+        return None
     
-    # Get recent plays (last 7 days)
-    recent_date = datetime.utcnow().replace(
-        hour=0, minute=0, second=0, microsecond=0
-    )
-    recent_plays = await db.songs.count_documents({
-        "last_played": {"$gte": recent_date}
-    })
+    buckets = min(buckets, len(chosen))
+    edges = np.linspace(0, len(chosen), buckets + 1).astype(np.int64)[:-1]
+    mins = np.minimum.reduceat(chosen[:, 0], edges)
+    maxs = np.maximum.reduceat(chosen[:, 1], edges)
+    return np.stack((mins, maxs), axis=1).astype(np.float64) / 32767
+
+
+def compute_features(file_path: str, content_hash: str) -> Optional[List[float]]:
+    """Compute a song's audio feature vector; runs in a worker process"""
+    decoded = decode_pcm(file_path)
+    if decoded is None:
+        return None
+    sample_rate, _, blocks = decoded
     
-    # Get most played songs
-    most_played = await db.songs.find().sort("play_count", -1).limit(10).to_list(10)
+    total_frames = 0
+    sum_squares = 0.0
+    centroid_sum = 0.0
+    centroid_weight = 0.0
+    envelope = []
+    frequencies = np.fft.rfftfreq(FEATURE_FFT_SIZE, 1 / sample_rate)
+    window = np.hanning(FEATURE_FFT_SIZE).astype(np.float32)
+    for block in blocks:
+        mono = block.mean(axis=1)
+        total_frames += len(mono)
+        sum_squares += float(np.dot(mono, mono))
+        
+        # Energy envelope for onset/tempo detection
+        hops = mono[:len(mono) - len(mono) % FEATURE_HOP_SIZE].reshape(-1, FEATURE_HOP_SIZE)
+        envelope.append(np.sqrt((hops ** 2).mean(axis=1)))
+        
+        # Energy-weighted spectral centroid over non-overlapping windows
+        frames = mono[:len(mono) - len(mono) % FEATURE_FFT_SIZE].reshape(-1, FEATURE_FFT_SIZE)
+        if len(frames):
+            spectrum = np.abs(np.fft.rfft(frames * window, axis=1))
+            magnitude = spectrum.sum(axis=1)
+            voiced = magnitude > 0
+            centroids = (spectrum[voiced] @ frequencies) / magnitude[voiced]
+            centroid_sum += float(np.dot(centroids, magnitude[voiced]))
+            centroid_weight += float(magnitude[voiced].sum())
+    if not total_frames:
+        return None
     
-    return {
-        "total_songs": total_songs,
-        "favorites": favorites,
-        "recent_plays": recent_plays,
-        "most_played": [Song(**song) for song in most_played]
-    }
+    rms = np.sqrt(sum_squares / total_frames)
+    loudness = 20 * np.log10(max(rms, 1e-6))
+    centroid = centroid_sum / centroid_weight if centroid_weight else 0.0
+    
+    # Tempo: strongest autocorrelation lag of the onset strength between 60 and 200 BPM
+    tempo = 0.0
+    onsets = np.diff(np.concatenate(envelope)) if envelope else np.empty(0)
+    onsets = np.maximum(onsets, 0)
+    envelope_rate = sample_rate / FEATURE_HOP_SIZE
+    min_lag, max_lag = int(envelope_rate * 60 / 200), int(envelope_rate * 60 / 60)
+    if len(onsets) > max_lag * 2 and onsets.any():
+        onsets = onsets - onsets.mean()
+        spectrum = np.fft.rfft(onsets, n=2 * len(onsets))
+        autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum))[:max_lag + 1]
+        # Weight lags towards 120 BPM to avoid half/double tempo picks
+        lags = np.arange(min_lag, max_lag + 1)
+        prior = np.exp(-0.5 * np.log2(60 * envelope_rate / lags / 120) ** 2)
+        lag = lags[int(np.argmax(autocorrelation[min_lag:max_lag + 1] * prior))]
+        tempo = 60 * envelope_rate / lag
+    
+    duration = total_frames / sample_rate
+    return [
+        float(loudness),
+        float(centroid / (sample_rate / 2)),
+        float(tempo),
+        float(np.log2(1 + duration / 60)),
+    ]
 
-@api_router.post("/playlists", response_model=Playlist)
-async def create_playlist(playlist_data: PlaylistCreate):
-    """Create a new playlist"""
-    playlist = Playlist(**playlist_data.dict())
-    await db.playlists.insert_one(playlist.dict())
-    return playlist
 
-@api_router.get("/playlists", response_model=List[Playlist])
-async def get_playlists():
-    """Get all playlists"""
-    playlists = await db.playlists.find().to_list(1000)
-    return [Playlist(**playlist) for playlist in playlists]
+def k_weighting_gain(frequencies: np.ndarray) -> np.ndarray:
+    """Squared magnitude response of the BS.1770 K-weighting filter"""
+    # Published 48 kHz biquads (high shelf, then high pass), evaluated at each frequency
+    z = np.exp(-1j * 2 * np.pi * np.minimum(frequencies, 23999.0) / 48000)
+    response = np.ones_like(z)
+    for b, a in (
+        ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),
+        ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),
+    ):
+        response *= (b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)
+    return np.abs(response) ** 2
 
-@api_router.put("/playlists/{playlist_id}/songs/{song_id}")
-async def add_song_to_playlist(playlist_id: str, song_id: str):
-    """Add a song to a playlist"""
-    playlist = await db.playlists.find_one({"id": playlist_id})
-    if not playlist:
-        raise HTTPException(status_code=404, detail="Playlist not found")
+
+def gated_loudness(block_energies: np.ndarray) -> Optional[float]:
+    """Integrated loudness (LUFS) of 400 ms block energies with absolute and relative gating"""
+    if not len(block_energies):
+        return None
+    with np.errstate(divide="ignore"):
+        block_loudness = -0.691 + 10 * np.log10(block_energies)
+    gated = block_energies[block_loudness > LOUDNESS_ABSOLUTE_GATE]
+    if not len(gated):
+        return None
+    relative_gate = -0.691 + 10 * np.log10(gated.mean()) + LOUDNESS_RELATIVE_GATE
+    gated = block_energies[block_loudness > max(relative_gate, LOUDNESS_ABSOLUTE_GATE)]
+    return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def loudness_blocks_path(content_hash: str) -> Path:
+    return INDEX_DIR / f"{content_hash}.loudness.npy"
+
+
+def compute_loudness(file_path: str, content_hash: str) -> Optional[dict]:
+    """Measure integrated loudness and sample peak; runs in a worker process
+
+    PCM is processed block by block: each 100 ms sub-block's K-weighted energy
+    comes from its spectrum (Parseval), so memory stays bounded. The 400 ms
+    gating-block energies are kept on disk for album gain calculation.
+    """
+    decoded = decode_pcm(file_path)
+    if decoded is None:
+        return None
+    sample_rate, channels, blocks = decoded
+    subblock = max(1, int(sample_rate * LOUDNESS_SUBBLOCK_SECONDS))
+    # K-weighting per rfft bin, with the one-sided spectrum doubling for Parseval
+    weights = k_weighting_gain(np.fft.rfftfreq(subblock, 1 / sample_rate)) * 2
+    weights[0] /= 2
+    if subblock % 2 == 0:
+        weights[-1] /= 2
+    weights /= subblock ** 2
     
-    song = await db.songs.find_one({"id": song_id})
-    if not song:
-        raise HTTPException(status_code=404, detail="Song not found")
+    energies = []
+    peak = 0.0
+    carry = np.empty((0, channels), dtype=np.float32)
+    for block in blocks:
+        if len(block):
+            peak = max(peak, float(np.abs(block).max()))
+        samples = np.concatenate((carry, block))
+        whole = len(samples) - len(samples) % subblock
+        frames = samples[:whole].reshape(-1, subblock, channels)
+        spectrum = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+        # Mean-square K-weighted signal, summed over channels
+        energies.append(np.einsum("fkc,k->f", spectrum, weights))
+        carry = samples[whole:]
+    if not energies:
+        return None
     
-    if song_id not in playlist["song_ids"]:
-        await db.playlists.update_one(
-            {"id": playlist_id},
-            {
-                "$push": {"song_ids": song_id},
-                "$set": {"updated_at": datetime.utcnow()}
-            }
-        )
+    # 400 ms gating blocks with 75% overlap, built from consecutive sub-blocks
+    subblock_energies = np.concatenate(energies)
+    if len(subblock_energies) < 4:
+        return None
+    block_energies = np.convolve(subblock_energies, np.full(4, 0.25), mode="valid").astype(np.float32)
+    integrated = gated_loudness(block_energies)
+    if integrated is None:
+        return None
     
-    return {"message": "Song added to playlist"}
+    temp_path = INDEX_DIR / f".{uuid.uuid4()}.npy"
+    np.save(temp_path, block_energies)
+    os.replace(temp_path, loudness_blocks_path(content_hash))
+    return {"integrated": integrated, "peak": peak}
 
-@api_router.get("/settings", response_model=UserSettings)
-async def get_settings():
-    """Get user settings"""
-    settings = await db.settings.find_one() or {}
-    return UserSettings(**settings)
 
-@api_router.put("/settings")
-async def update_settings(settings: UserSettings):
-    """Update user settings"""
-    await db.settings.replace_one(
-        {},
-        settings.dict(),
-        upsert=True
-    )
-    return settings
+def album_loudness(content_hashes: List[str]) -> Optional[float]:
+    """Integrated loudness over the gating blocks of every track in an album"""
+    blocks = [np.load(loudness_blocks_path(content_hash), mmap_mode="r")
+              for content_hash in content_hashes if loudness_blocks_path(content_hash).exists()]
+    return gated_loudness(np.concatenate(blocks)) if blocks else None
 
-# Include the router in the main app
-app.include_router(api_router)
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=["*"],
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+def equalizer_kernel(bands: List[float], sample_rate: int) -> np.ndarray:
+    """FIR approximation of the cascaded peaking biquads for the given band gains
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+    The cascade's frequency response is sampled on an EQ_FIR_TAPS-point grid
+    and inverted; the biquads' impulse responses decay well within that
+    length. A pre-gain equal to the largest boost keeps the output from
+    clipping.
+    """
+    z = np.exp(-1j * 2 * np.pi * np.fft.rfftfreq(EQ_FIR_TAPS))
+    response = np.ones_like(z)
+    for frequency, gain in zip(EQ_FREQUENCIES, bands):
+        if not gain or frequency >= sample_rate / 2:
+            continue
+        # RBJ audio EQ cookbook peaking filter
+        amplitude = 10 ** (gain / 40)
+        w0 = 2 * np.pi * frequency / sample_rate
+        alpha = np.sin(w0) / (2 * EQ_Q)
+        b = (1 + alpha * amplitude, -2 * np.cos(w0), 1 - alpha * amplitude)
+        a = (1 + alpha / amplitude, -2 * np.cos(w0), 1 - alpha / amplitude)
+        response *= (b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)
+    preamp = 10 ** (-max(max(bands, default=0.0), 0.0) / 20)
+    return (np.fft.irfft(response, EQ_FIR_TAPS) * preamp).astype(np.float32)
+
+
+def equalize_blocks(blocks: Iterator[np.ndarray], kernel: np.ndarray) -> Iterator[np.ndarray]:
+    """Filter (frames, channels) blocks with an FIR kernel by FFT overlap-add"""
+    taps = len(kernel)
+    tail = None
+    spectra = {}
+    for block in blocks:
+        frames = len(block)
+        if not frames:
+            continue
+        size = 1 << (frames + taps - 2).bit_length()
+        if size not in spectra:
+            spectra[size] = np.fft.rfft(kernel, size)[:, None]
+        filtered = np.fft.irfft(np.fft.rfft(block, size, axis=0) * spectra[size], size, axis=0)[:frames + taps - 1]
+        if tail is not None:
+            filtered[:taps - 1] += tail
+        tail = filtered[frames:]
+        yield filtered[:frames]
+
+
+def wav_header(sample_rate: int, channels: int, data_bytes: int = 0xFFFFFFFF - 36) -> bytes:
+    """Header for 16-bit PCM WAV; the default size marks a stream of unknown length"""
+    return (b"RIFF" + struct.pack("<I", data_bytes + 36) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, sample_rate * channels * 2, channels * 2, 16)
+            + b"data" + struct.pack("<I", data_bytes))
+
+
+def equalizer_cache_path(key: str, bands: List[float]) -> Path:
+    bands_key = hashlib.sha1(",".join(f"{gain:.1f}" for gain in bands).encode()).hexdigest()[:16]
+    return INDEX_DIR / f"{key}.eq-{bands_key}.wav"
+
+
+def prune_equalizer_cache():
+    """Delete the least recently served rendered streams beyond EQ_CACHE_BYTES"""
+    entries = []
+    for path in INDEX_DIR.glob("*.eq-*.wav"):
+        try:
+            entries.append((path.stat(), path))
+        except FileNotFoundError:
+            continue
+    total = sum(stat.st_size for stat, _ in entries)
+    for stat, path in sorted(entries, key=lambda entry: entry[0].st_atime):
+        if total <= EQ_CACHE_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total -= stat.st_size
+
+
+def render_equalized(decoded: Tuple[int, int, Iterator[np.ndarray]], bands: List[float],
+                     cache_path: Path) -> Iterator[bytes]:
+    """Equalize decoded PCM to 16-bit WAV, yielding chunks as they are rendered
+
+    The output is written alongside to a staging file that replaces
+    ``cache_path`` once the whole track has been rendered.
+    """
+    sample_rate, channels, blocks = decoded
+    kernel = equalizer_kernel(bands, sample_rate)
+    temp_path = INDEX_DIR / f".{uuid.uuid4()}.part"
+    complete = False
+    try:
+        with open(temp_path, "wb") as f:
+            header = wav_header(sample_rate, channels)
+            f.write(header)
+            yield header
+            data_bytes = 0
+            for block in equalize_blocks(blocks, kernel):
+                chunk = (np.clip(block, -1.0, 32767 / 32768) * 32768).astype("<i2").tobytes()
+                f.write(chunk)
+                data_bytes += len(chunk)
+                yield chunk
+            f.seek(0)
+            f.write(wav_header(sample_rate, channels, data_bytes))
+        os.replace(temp_path, cache_path)
+        complete = True
+        prune_equalizer_cache()
+    finally:
+        if not complete:
+            temp_path.unlink(missing_ok=True)
+
+
+class FeatureIndex:
+    """In-memory float32 matrix of audio feature vectors, one row per content hash"""
+
+    def __init__(self, dimensions: int):
+        self.hashes = []
+        self.rows = {}
+        self.matrix = np.empty((0, dimensions), dtype=np.float32)
+        self.size = 0
+        self.normalized = None
+
+    def add(self, content_hash: str, vector: List[float]):
+        row = self.rows.get(content_hash)
+        if row is None:
+            if self.size == len(self.matrix):
+                grown = np.empty((max(64, 2 * len(self.matrix)), self.matrix.shape[1]), dtype=np.float32)
+                grown[:self.size] = self.matrix[:self.size]
+                self.matrix = grown
+            row = self.size
+            self.rows[content_hash] = row
+            self.hashes.append(content_hash)
+            self.size += 1
+        self.matrix[row] = vector
+        self.normalized = None
+
+    def similar(self, content_hash: str, limit: int) -> List[Tuple[str, float]]:
+        """Top ``limit`` (content_hash, cosine similarity) pairs, excluding the seed"""
+        row = self.rows.get(content_hash)
+        if row is None or self.size < 2:
+            return []
+        if self.normalized is None:
+            # Standardize each feature, then scale rows to unit length
+            features = self.matrix[:self.size]
+            std = features.std(axis=0)
+            standardized = (features - features.mean(axis=0)) / np.where(std > 0, std, 1)
+            norms = np.linalg.norm(standardized, axis=1, keepdims=True)
+            self.normalized = standardized / np.where(norms > 0, norms, 1)
+        
+        scores = self.normalized @ self.normalized[row]
+        scores[row] = -np.inf
+        limit = min(limit, self.size - 1)
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(self.hashes[i], float(scores[i])) for i in top]
+
+
+feature_index = FeatureIndex(FEATURE_DIMENSIONS)
+
+
+class ByteLRUCache:
+    """Least-recently-used cache of bytes values bounded by total size"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries: "OrderedDict[object, bytes]" = OrderedDict()
+
+    def get(self, key) -> Optional[bytes]:
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value: bytes):
+        if len(value) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.current_bytes -= len(self.entries.pop(key))
+        self.entries[key] = value
+        self.current_bytes += len(value)
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.current_bytes -= len(evicted)
+
+
+artwork_cache = ByteLRUCache(ARTWORK_CACHE_BYTES)
+
+
+class AudioBlockCache(ByteLRUCache):
+    """LRU cache of fixed-size audio file blocks with second-hit admission
+
+    A block is only admitted once it has missed twice within the recent miss
+    history, so one pass over a cold track cannot evict the popular catalogue.
+    """
+
+    def __init__(self, max_bytes: int, block_size: int):
+        super().__init__(max_bytes)
+        self.block_size = block_size
+        self.ghosts = OrderedDict()
+        self.max_ghosts = max(1024, 4 * max_bytes // block_size)
+
+    def lookup(self, key) -> Tuple[Optional[bytes], bool]:
+        """Return (cached block, whether the caller should read and admit it)"""
+        data = self.get(key)
+        if data is not None:
+            audio_cache_requests.inc(1, "hit")
+            return data, False
+        audio_cache_requests.inc(1, "miss")
+        if key in self.ghosts:
+            del self.ghosts[key]
+            return None, True
+        self.ghosts[key] = None
+        if len(self.ghosts) > self.max_ghosts:
+            self.ghosts.popitem(last=False)
+        return None, False
+
+    def put(self, key, value: bytes):
+        super().put(key, value)
+        audio_cache_bytes.set(self.current_bytes)
+
+
+audio_cache = AudioBlockCache(AUDIO_CACHE_BYTES, AUDIO_CACHE_BLOCK_SIZE)
+
+
+def normalize_text(text: str) -> str:
+    """Lowercase and strip accents and punctuation for search matching"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return " ".join("".join(ch if ch.isalnum() else " " for ch in text.lower()).split())
+
+
+def text_trigrams(text: str, prefix: bool = False) -> set:
+    """Trigrams of each padded word; prefix mode leaves the last word open-ended"""
+    words = text.split()
+    grams = set()
+    for i, word in enumerate(words):
+        padded = f"  {word}" if prefix and i == len(words) - 1 else f"  {word} "
+        grams.update(padded[j:j + 3] for j in range(len(padded) - 2))
+    return grams
+
+
+class SearchIndex:
+    """In-memory trigram index over song title, artist and album"""
+
+    FIELDS = ("title", "artist", "album")
+    FIELD_WEIGHTS = {"title": 3.0, "artist": 2.0, "album": 1.0}
+    MAX_CANDIDATES = 2000
+
+    def __init__(self):
+        self.documents = {}
+        self.postings = {}
+
+    def add(self, song: dict):
+        song_id = song["id"]
+        if song_id in self.documents:
+            self.remove(song_id)
+        fields = {field: normalize_text(song.get(field, "")) for field in self.FIELDS}
+        self.documents[song_id] = fields
+        for gram in text_trigrams(" ".join(fields.values())):
+            self.postings.setdefault(gram, set()).add(song_id)
+
+    def remove(self, song_id: str):
+        fields = self.documents.pop(song_id, None)
+        if not fields:
+            return
+        for gram in text_trigrams(" ".join(fields.values())):
+            posting = self.postings.get(gram)
+            if posting:
+                posting.discard(song_id)
+                if not posting:
+                    del self.postings[gram]
+
+    def search(self, query: str, limit: int = 20) -> List[Tuple[str, float]]:
+        """Return (song_id, score) pairs ranked best first"""
+        query = normalize_text(query)
+        grams = text_trigrams(query, prefix=True)
+        if not grams:
+            return []
+        
+        # A match must share min_hits trigrams with the query, so it appears in
+        # at least one of the rarest len(grams) - min_hits + 1 posting lists
+        # lists. Very common queries are capped at MAX_CANDIDATES, which only
+        # drops equally good matches.
+        postings = sorted((self.postings.get(gram, set()) for gram in grams), key=len)
+        min_hits = max(1, (len(grams) + 1) // 2)
+        required = len(postings) - min_hits + 1
+        pool = set()
+        for posting in postings[:required]:
+            pool.update(islice(posting, self.MAX_CANDIDATES - len(pool)))
+            if len(pool) >= self.MAX_CANDIDATES:
+                break
+        hits = ((song_id, sum(song_id in posting for posting in postings)) for song_id in pool)
+        candidates = heapq.nlargest(limit * 10, (item for item in hits if item[1] >= min_hits),
+                                    key=lambda item: item[1])
+        
+        query_words = query.split()
+        scored = []
+        for song_id, count in candidates:
+            fields = self.documents[song_id]
+            score = count / len(grams)
+            for field, value in fields.items():
+                weight = self.FIELD_WEIGHTS[field]
+                if value == query:
+                    score += weight
+                elif value.startswith(query):
+                    score += weight * 0.75
+                elif query in value:
+                    score += weight * 0.5
+                elif all(any(word.startswith(q) for word in value.split()) for q in query_words):
+                    score += weight * 0.25
+            scored.append((song_id, score))
+        return heapq.nlargest(limit, scored, key=lambda item: item[1])
+
+
+search_index = SearchIndex()
+
+
+class LibraryVersion:
+    """Monotonic library version, bumped on every mutation
+
+    Persisted in the counters collection under ``counter``; the current
+    value is kept in memory so conditional requests can be answered without
+    a query.
+    """
+
+    def __init__(self, counter: str = "library_version"):
+        self.counter = counter
+        self.value = 0
+        self.latest = 0
+        self.pending = set()
+
+    async def load(self):
+        counter = await db.counters.find_one({"_id": self.counter})
+        self.value = self.latest = counter["value"] if counter else 0
+
+    @asynccontextmanager
+    async def change(self):
+        """Reserve the next version for a mutation made inside the block
+
+        The reserved number is written with the change, but ``value`` only
+        moves past it once the block exits, and never past a version whose
+        block is still running. ETags and ?since= readers therefore never see
+        a version before its writes and in-memory updates are complete.
+        """
+        counter = await db.counters.find_one_and_update(
+            {"_id": self.counter},
+            {"$inc": {"value": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        version = counter["value"]
+        self.pending.add(version)
+        self.latest = max(self.latest, version)
+        try:
+            yield version
+        finally:
+            self.pending.discard(version)
+            published = min(self.pending) - 1 if self.pending else self.latest
+            self.value = max(self.value, published)
+
+    def etag(self, request: Request) -> str:
+        """Weak ETag for a listing: library version plus the request's query"""
+        return f'W/"{self.value}-{zlib.crc32(request.url.query.encode("utf-8")):08x}"'
+
+
+library_version = LibraryVersion()
+# Playlist mutations also bump their own counter, so that play flushes and
+# background analysis do not invalidate playlist ETags
+playlist_version = LibraryVersion("playlist_version")
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]
+
+
+class EventHub:
+    """In-process fan-out of library change events to SSE subscribers
+
+    Events are formatted once on publish and pushed onto each subscriber's
+    bounded queue. A subscriber that falls behind is dropped with a resync
+    marker instead of blocking publishers. Recent events are kept so a client
+    reconnecting with Last-Event-ID can catch up without a full refetch.
+    """
+
+    def __init__(self, queue_size: int, history_size: int):
+        self.queue_size = queue_size
+        self.history = deque(maxlen=history_size)
+        self.subscribers = set()
+        self.sequence = 0
+
+    def publish(self, event_type: str, data: dict):
+        self.sequence += 1
+        payload = json.dumps(data, default=json_default, separators=(",", ":"))
+        message = f"id: {self.sequence}\nevent: {event_type}\ndata: {payload}\n\n"
+        self.history.append((self.sequence, message))
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.subscribers.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def subscribe(self, last_event_id: Optional[int] = None) -> asyncio.Queue:
+        queue = asyncio.Queue(self.queue_size)
+        if last_event_id is not None and last_event_id < self.sequence:
+            missed = [message for sequence, message in self.history if sequence > last_event_id]
+            oldest = self.history[0][0] if self.history else self.sequence + 1
+            if last_event_id < oldest - 1 or len(missed) >= self.queue_size:
+                # The gap is no longer in history; the client must refetch
+                queue.put_nowait(None)
+                return queue
+            for message in missed:
+                queue.put_nowait(message)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.discard(queue)
+
+
+event_hub = EventHub(EVENT_QUEUE_SIZE, EVENT_HISTORY_SIZE)
+
+
+class StatsSnapshot:
+    """Cached library statistics, maintained incrementally between refreshes
+
+    A full refresh is one $facet aggregation for the counters plus a
+    projected cursor over recently played songs, which would not fit in a
+    facet result (capped at 16 MB) on a large library; uploads, favorite
+    toggles and play flushes then adjust the snapshot in place. The snapshot is rebuilt
+    every STATS_REFRESH_INTERVAL seconds to pick up changes made elsewhere.
+    """
+
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.refreshed_at = None
+        self.total_songs = 0
+        self.favorites = 0
+        self.recent = {}
+        self.most_played = []
+        self.lock = asyncio.Lock()
+
+    async def refresh(self):
+        async with self.lock:
+            window_start = datetime.utcnow() - RECENT_PLAYS_WINDOW
+            result = await db.songs.aggregate([
+                {"$facet": {
+                    "totals": [{"$group": {
+                        "_id": None,
+                        "total_songs": {"$sum": 1},
+                        "favorites": {"$sum": {"$cond": [{"$eq": ["$is_favorite", True]}, 1, 0]}}
+                    }}],
+                    "most_played": [
+                        {"$sort": {"play_count": -1, "id": 1}},
+                        {"$limit": MOST_PLAYED_LIMIT},
+                        {"$project": {"_id": 0}}
+                    ]
+                }}
+            ]).to_list(1)
+            recent = {}
+            async for song in db.songs.find({"last_played": {"$gte": window_start}},
+                                            {"_id": 0, "id": 1, "last_played": 1}):
+                recent[song["id"]] = song["last_played"]
+            facets = result[0] if result else {}
+            totals = (facets.get("totals") or [{}])[0]
+            self.total_songs = totals.get("total_songs", 0)
+            self.favorites = totals.get("favorites", 0)
+            self.recent = recent
+            self.most_played = facets.get("most_played", [])
+            self.refreshed_at = time.monotonic()
+        self.publish()
+
+    async def get(self) -> dict:
+        if self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.refresh_interval:
+            await self.refresh()
+        window_start = datetime.utcnow() - RECENT_PLAYS_WINDOW
+        self.recent = {song_id: played for song_id, played in self.recent.items() if played >= window_start}
+        return {
+            "total_songs": self.total_songs,
+            "favorites": self.favorites,
+            "recent_plays": len(self.recent),
+            "most_played": [Song(**song) for song in self.most_played]
+        }
+
+    def publish(self):
+        """Push the current counters to event subscribers"""
+        event_hub.publish("stats", {
+            "total_songs": self.total_songs,
+            "favorites": self.favorites,
+            "recent_plays": len(self.recent),
+            "most_played": [song["id"] for song in self.most_played]
+        })
+
+    def songs_added(self, songs: List[dict]):
+        self.total_songs += len(songs)
+        self.merge_most_played(songs)
+        self.publish()
+
+    def favorite_changed(self, song_id: str, is_favorite: bool):
+        self.favorites += 1 if is_favorite else -1
+        for song in self.most_played:
+            if song["id"] == song_id:
+                song["is_favorite"] = is_favorite
+        self.publish()
+
+    def plays_recorded(self, songs: List[dict]):
+        """Pick up new play counts for songs just flushed by the play buffer"""
+        for song in songs:
+            if song.get("last_played"):
+                self.recent[song["id"]] = song["last_played"]
+        self.merge_most_played(songs)
+        self.publish()
+
+    def merge_most_played(self, songs: List[dict]):
+        merged = {song["id"]: song for song in self.most_played}
+        merged.update((song["id"], song) for song in songs)
+        self.most_played = heapq.nsmallest(
+            MOST_PLAYED_LIMIT, merged.values(),
+            key=lambda song: (-song.get("play_count", 0), song["id"])
+        )
+
+
+stats_snapshot = StatsSnapshot(STATS_REFRESH_INTERVAL)
+
+
+def hour_start(moment: datetime) -> datetime:
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def day_start(moment: datetime) -> datetime:
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+class PlayCountBuffer:
+    """Write-behind buffer for play counts and play history
+
+    Plays are aggregated per song and flushed with one bulk_write. Repeat
+    plays of a song by the same session within the dedup window are ignored.
+    Each counted play is also appended to db.play_events, and the hourly and
+    daily rollups it falls into are recounted in the same flush.
+    """
+
+    def __init__(self, dedup_window: float):
+        self.dedup_window = dedup_window
+        self.pending = {}
+        self.last_played = {}
+        self.events = []
+        self.recent = {}
+        self.lock = asyncio.Lock()
+
+    def record(self, song_id: str, session: str):
+        now = time.monotonic()
+        key = (song_id, session)
+        last = self.recent.get(key)
+        self.recent[key] = now
+        if last is not None and now - last < self.dedup_window:
+            return
+        played_at = datetime.utcnow()
+        self.pending[song_id] = self.pending.get(song_id, 0) + 1
+        self.last_played[song_id] = played_at
+        self.events.append({"song_id": song_id, "played_at": played_at})
+
+    async def flush(self):
+        async with self.lock:
+            cutoff = time.monotonic() - self.dedup_window
+            self.recent = {key: seen for key, seen in self.recent.items() if seen >= cutoff}
+            if not self.pending and not self.events:
+                return
+            pending, self.pending = self.pending, {}
+            last_played, self.last_played = self.last_played, {}
+            events, self.events = self.events, []
+            song_ids = list(pending)
+            try:
+                await self.write_history(events)
+            except Exception as e:
+                logging.error(f"Error writing play history: {e}")
+                self.events = events + self.events
+            if not pending:
+                return
+            try:
+                async with library_version.change() as version:
+                    operations = [
+                        UpdateOne(
+                            {"id": song_id},
+                            {
+                                "$inc": {"play_count": pending[song_id]},
+                                "$max": {"last_played": last_played[song_id]},
+                                "$set": {"version": version}
+                            }
+                        )
+                        for song_id in song_ids
+                    ]
+                    try:
+                        await db.songs.bulk_write(operations, ordered=False)
+                    except BulkWriteError:
+                        # Some updates may have applied; keep the catalog in step with them
+                        await song_catalog.reload({"id": {"$in": song_ids}})
+                        raise
+                    songs = await db.songs.find({"id": {"$in": song_ids}}, {"_id": 0}).to_list(len(song_ids))
+                    song_catalog.upsert(songs)
+                event_hub.publish("play_counts", {"version": version, "increments": pending})
+                stats_snapshot.plays_recorded(songs)
+                return
+            except BulkWriteError as e:
+                failed = [song_ids[error["index"]] for error in e.details.get("writeErrors", [])]
+                logging.error(f"Error flushing play counts for {len(failed)} songs: {e}")
+            except Exception as e:
+                failed = song_ids
+                logging.error(f"Error flushing play counts: {e}")
+            
+            # Keep the failed increments for the next flush
+            for song_id in failed:
+                self.pending[song_id] = self.pending.get(song_id, 0) + pending[song_id]
+                self.last_played[song_id] = max(last_played[song_id],
+                                                self.last_played.get(song_id, last_played[song_id]))
+
+    async def write_history(self, events: List[dict]):
+        """Append play events and rebuild the hourly and daily rollups they touch
+
+        Events keep the _id assigned on their first insert, so a retried flush
+        skips events that were already stored. Rollup buckets are recounted
+        from db.play_events rather than incremented, so a retry after a partial
+        failure cannot count a play twice.
+        """
+        if not events:
+            return
+        try:
+            await db.play_events.insert_many(events, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        
+        song_ids = list({event["song_id"] for event in events})
+        songs = {
+            song["id"]: song
+            for song in await db.songs.find(
+                {"id": {"$in": song_ids}}, {"_id": 0, "id": 1, "artist": 1, "duration": 1}
+            ).to_list(len(song_ids))
+        }
+        for collection, period_start, period in (
+            (db.play_rollups_hourly, hour_start, timedelta(hours=1)),
+            (db.play_rollups_daily, day_start, timedelta(days=1)),
+        ):
+            buckets = {}
+            for event in events:
+                buckets.setdefault(period_start(event["played_at"]), set()).add(event["song_id"])
+            operations = []
+            for start, bucket_song_ids in buckets.items():
+                counts = await db.play_events.aggregate([
+                    {"$match": {
+                        "song_id": {"$in": list(bucket_song_ids)},
+                        "played_at": {"$gte": start, "$lt": start + period}
+                    }},
+                    {"$group": {"_id": "$song_id", "plays": {"$sum": 1}}}
+                ]).to_list(None)
+                for count in counts:
+                    song = songs.get(count["_id"], {})
+                    operations.append(UpdateOne(
+                        {"start": start, "song_id": count["_id"]},
+                        {
+                            "$set": {
+                                "plays": count["plays"],
+                                "listening_seconds": count["plays"] * (song.get("duration") or 0.0)
+                            },
+                            "$setOnInsert": {"artist": song.get("artist") or "Unknown Artist"}
+                        },
+                        upsert=True
+                    ))
+            if operations:
+                await collection.bulk_write(operations, ordered=False)
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+
+play_buffer = PlayCountBuffer(PLAY_DEDUP_WINDOW)
+play_flush_task: Optional[asyncio.Task] = None
+
+
+def record_play(request: Request, song_id: str):
+    """Buffer a play for the requesting listening session"""
+    session = request.headers.get("x-session-id") or \
+        f"{request.client.host if request.client else ''}|{request.headers.get('user-agent', '')}"
+    play_buffer.record(song_id, session)
+
+
+def analytics_window(start: Optional[datetime], end: Optional[datetime]) -> Tuple[datetime, datetime]:
+    """Resolve an analytics window to naive UTC datetimes on hour boundaries"""
+    def utc(moment: datetime) -> datetime:
+        if moment.tzinfo is not None:
+            moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+        return moment
+    
+    end = utc(end) if end else datetime.utcnow()
+    start = utc(start) if start else end - ANALYTICS_DEFAULT_WINDOW
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    end_hour = hour_start(end)
+    if end_hour < end:
+        end_hour += timedelta(hours=1)
+    return hour_start(start), end_hour
+
+
+async def rollup_totals(start: datetime, end: datetime, group_field: str) -> dict:
+    """Sum plays and listening time per ``group_field`` over [start, end)
+
+    Whole days are read from the daily rollup and the partial days at either
+    end from the hourly one, so cost depends on the window, not on history.
+    """
+    first_day = day_start(start)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = day_start(end)
+    if first_day < last_day:
+        ranges = [(db.play_rollups_hourly, start, first_day), (db.play_rollups_daily, first_day, last_day),
+                  (db.play_rollups_hourly, last_day, end)]
+    else:
+        ranges = [(db.play_rollups_hourly, start, end)]
+    
+    totals = {}
+    for collection, low, high in ranges:
+        if low >= high:
+            continue
+        async for row in collection.aggregate([
+            {"$match": {"start": {"$gte": low, "$lt": high}}},
+            {"$group": {
+                "_id": f"${group_field}",
+                "plays": {"$sum": "$plays"},
+                "listening_seconds": {"$sum": "$listening_seconds"}
+            }}
+        ]):
+            total = totals.setdefault(row["_id"], {"plays": 0, "listening_seconds": 0.0})
+            total["plays"] += row["plays"]
+            total["listening_seconds"] += row["listening_seconds"]
+    return totals
+
+
+def parse_range_header(range_header: Optional[str], file_size: int) -> Optional[List[Tuple[int, int]]]:
+    """Parse a Range header into sorted, merged (start, end) byte ranges.
+
+    Returns None when the header should be ignored (missing, malformed, not
+    bytes, too many ranges) and raises a 416 when no range is satisfiable.
+    """
+    if not range_header:
+        return None
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not sep or not (first.isdigit() or first == "") or not (last.isdigit() or last == ""):
+            return None
+        if first == "":
+            # Suffix range: last N bytes
+            if last == "":
+                return None
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(file_size - length, 0), file_size - 1))
+        else:
+            start = int(first)
+            end = int(last) if last else file_size - 1
+            if last and end < start:
+                return None
+            if start >= file_size:
+                continue
+            ranges.append((start, min(end, file_size - 1)))
+
+    if not ranges:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+
+    # Coalesce overlapping and adjacent ranges
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end + 1:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+class FileRangeResponse(Response):
+    """Serve byte ranges of a local file, zero-copy when the server supports it
+
+    Uses the ASGI ``http.response.zerocopysend`` extension (os.sendfile) when
+    advertised, otherwise falls back to positional reads in a worker thread.
+    Uvicorn does not advertise the extension, so under uvicorn the fallback
+    (or the audio cache) always serves the bytes.
+    With a ``cache_key`` (which must change whenever the file does), blocks
+    are served from and admitted to the in-memory audio cache. With an
+    ``offset`` the resource is the file from that byte on, and ``ranges``
+    and Content-Range are relative to it.
+    """
+
+    def __init__(self, path: Path, file_size: int, ranges: Optional[List[Tuple[int, int]]] = None,
+                 media_type: str = "application/octet-stream", headers: Optional[dict] = None,
+                 offset: int = 0, cache_key: Optional[str] = None):
+        self.path = path
+        self.cache_key = cache_key if audio_cache.max_bytes else None
+        self.body = None
+        self.background = None
+        headers = dict(headers or {})
+        headers["Accept-Ranges"] = "bytes"
+        size = file_size - offset
+
+        if not ranges:
+            self.status_code = 200
+            self.media_type = media_type
+            self.segments = [(b"", offset, file_size - 1)] if size > 0 else []
+            self.epilogue = b""
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.status_code = 206
+            self.media_type = media_type
+            self.segments = [(b"", offset + start, offset + end)]
+            self.epilogue = b""
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        else:
+            boundary = uuid.uuid4().hex
+            self.status_code = 206
+            self.media_type = f"multipart/byteranges; boundary={boundary}"
+            self.segments = []
+            for i, (start, end) in enumerate(ranges):
+                part_header = (
+                    f"--{boundary}\r\n"
+                    f"Content-Type: {media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode("latin-1")
+                if i:
+                    part_header = b"\r\n" + part_header
+                self.segments.append((part_header, offset + start, offset + end))
+            self.epilogue = f"\r\n--{boundary}--\r\n".encode("latin-1")
+
+        content_length = sum(len(prefix) + end - start + 1 for prefix, start, end in self.segments)
+        headers["Content-Length"] = str(content_length + len(self.epilogue))
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": self.status_code,
+            "headers": self.raw_headers,
+        })
+        if scope.get("method") == "HEAD":
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        with open(self.path, "rb") as f:
+            for prefix, start, end in self.segments:
+                if prefix:
+                    await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                if self.cache_key:
+                    await self.send_cached(f, start, end, zerocopy, send)
+                else:
+                    await self.send_file(f, start, end, zerocopy, send)
+        await send({"type": "http.response.body", "body": self.epilogue, "more_body": False})
+
+    async def send_file(self, f, start: int, end: int, zerocopy: bool, send) -> None:
+        if zerocopy:
+            await send({
+                "type": "http.response.zerocopysend",
+                "file": f,
+                "offset": start,
+                "count": end - start + 1,
+                "more_body": True,
+            })
+            stream_bytes_sent.inc(end - start + 1, "zerocopy")
+            return
+        offset = start
+        while offset <= end:
+            size = min(STREAM_CHUNK_SIZE, end - offset + 1)
+            chunk = await anyio.to_thread.run_sync(os.pread, f.fileno(), size, offset)
+            if not chunk:
+                break
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            stream_bytes_sent.inc(len(chunk), "read")
+            offset += len(chunk)
+
+    async def send_cached(self, f, start: int, end: int, zerocopy: bool, send) -> None:
+        block_size = audio_cache.block_size
+        for index in range(start // block_size, end // block_size + 1):
+            block_start = index * block_size
+            low, high = max(start, block_start), min(end, block_start + block_size - 1)
+            key = (self.cache_key, index)
+            data, admit = audio_cache.lookup(key)
+            if admit:
+                data = await anyio.to_thread.run_sync(os.pread, f.fileno(), block_size, block_start)
+                audio_cache.put(key, data)
+            if data is None:
+                await self.send_file(f, low, high, zerocopy, send)
+                continue
+            body = data[low - block_start:high - block_start + 1]
+            if not body:
+                break
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+            stream_bytes_sent.inc(len(body), "cache")
+
+
+def warm_file(file_path: str, head_bytes: int) -> int:
+    """Pull a file into the OS page cache ahead of playback
+
+    The whole file is advised WILLNEED so the kernel reads ahead
+    asynchronously; the head is also read synchronously so the first bytes
+    are resident even on filesystems that ignore the advice.
+    """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        warmed = 0
+        while warmed < head_bytes:
+            chunk = os.pread(fd, min(UPLOAD_CHUNK_SIZE, head_bytes - warmed), warmed)
+            if not chunk:
+                break
+            warmed += len(chunk)
+        return warmed
+    finally:
+        os.close(fd)
+
+
+class Prefetcher:
+    """Warms upcoming tracks on a small dedicated thread pool
+
+    Files warmed within the last ``ttl`` seconds are skipped, so repeated
+    hints for the same queue cost nothing.
+    """
+
+    def __init__(self, workers: int, ttl: float, head_bytes: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.ttl = ttl
+        self.head_bytes = head_bytes
+        self.recent = OrderedDict()
+
+    def warm(self, file_path: str) -> bool:
+        now = time.monotonic()
+        while self.recent and next(iter(self.recent.values())) < now - self.ttl:
+            self.recent.popitem(last=False)
+        if file_path in self.recent:
+            return False
+        self.recent[file_path] = now
+        self.executor.submit(self.run, file_path)
+        return True
+
+    def run(self, file_path: str):
+        try:
+            prefetch_bytes_warmed.inc(warm_file(file_path, self.head_bytes))
+        except OSError as e:
+            logging.debug(f"Could not prefetch {file_path}: {e}")
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+prefetcher = Prefetcher(PREFETCH_WORKERS, PREFETCH_TTL, PREFETCH_HEAD_BYTES)
+
+
+async def prefetch_songs(song_ids: List[str]) -> Tuple[List[str], List[str]]:
+    """Start warming the next few queued songs; returns (warming, missing) ids"""
+    song_ids = list(dict.fromkeys(song_ids))[:PREFETCH_TRACKS]
+    songs = await db.songs.find(
+        {"id": {"$in": song_ids}}, {"_id": 0, "id": 1, "file_path": 1}
+    ).to_list(len(song_ids))
+    paths = {song["id"]: song["file_path"] for song in songs}
+    for song_id in song_ids:
+        if song_id in paths:
+            prefetcher.warm(paths[song_id])
+    return [i for i in song_ids if i in paths], [i for i in song_ids if i not in paths]
+
+
+def preload_links(song_ids: List[str]) -> str:
+    """Link header value asking the client to preload the given streams"""
+    return ", ".join(
+        f"<{api_router.prefix}/songs/{song_id}/stream>; rel=preload; as=audio" for song_id in song_ids
+    )
+
+
+async def extract_metadata_async(file_path: str, content_hash: Optional[str] = None) -> dict:
+    """Run extract_file_metadata in the process pool without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(metadata_executor, extract_file_metadata, file_path, content_hash)
+    finally:
+        metadata_extract_duration.observe(time.perf_counter() - start)
+
+
+seek_index_cache = ByteLRUCache(8 * 1024 * 1024)
+
+
+async def seek_offset(content_hash: str, seconds: float) -> Optional[Tuple[int, float]]:
+    """Map a time to (byte offset, actual start time) using a song's seek index"""
+    if not content_hash:
+        return None
+    data = seek_index_cache.get(content_hash)
+    if data is None:
+        index_path = INDEX_DIR / f"{content_hash}.seek"
+        if not index_path.exists():
+            return None
+        async with aiofiles.open(index_path, 'rb') as f:
+            data = await f.read()
+        seek_index_cache.put(content_hash, data)
+    
+    interval = struct.unpack_from("<d", data)[0]
+    entries = (len(data) - 8) // 8
+    entry = min(max(int(seconds / interval), 0), entries - 1)
+    return struct.unpack_from("<Q", data, 8 + entry * 8)[0], entry * interval
+
+
+analysis_jobs = {}
+analysis_unavailable = set()
+
+
+def schedule_analysis(kind: str, func, *args) -> asyncio.Future:
+    """Run a background analysis job in the analysis pool, once per (kind, key)"""
+    key = (kind, args[-1])
+    job = analysis_jobs.get(key)
+    if job is None:
+        loop = asyncio.get_running_loop()
+        job = loop.run_in_executor(analysis_executor, func, *args)
+        analysis_jobs[key] = job
+        
+        def done(future):
+            analysis_jobs.pop(key, None)
+            if future.cancelled():
+                return
+            if future.exception():
+                logging.error(f"Error running {kind} analysis: {future.exception()}")
+            elif future.result() in (None, False):
+                # No decoder or no usable audio for this file; don't retry on every request
+                analysis_unavailable.add(key)
+        job.add_done_callback(done)
+    return job
+
+
+background_tasks = set()
+
+
+def run_in_background(coroutine):
+    """Start a fire-and-forget task, keeping a reference until it finishes"""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+async def analyze_features(file_path: str, content_hash: str):
+    """Compute a song's feature vector in the worker pool and index it"""
+    try:
+        vector = await schedule_analysis("features", compute_features, file_path, content_hash)
+    except Exception:
+        return
+    if vector is None:
+        return
+    await db.features.update_one(
+        {"hash": content_hash},
+        {"$set": {"vector": vector, "updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+    feature_index.add(content_hash, vector)
+
+
+async def analyze_loudness(file_path: str, content_hash: str):
+    """Measure a track's loudness in the worker pool and store its ReplayGain values"""
+    loudness = await db.loudness.find_one({"hash": content_hash})
+    if not loudness:
+        try:
+            result = await schedule_analysis("loudness", compute_loudness, file_path, content_hash)
+        except Exception:
+            return
+        if result is None:
+            return
+        loudness = {"hash": content_hash, **result}
+        await db.loudness.update_one({"hash": content_hash}, {"$set": loudness}, upsert=True)
+    
+    async with library_version.change() as version:
+        await db.songs.update_many(
+            {"content_hash": content_hash},
+            {"$set": {
+                "track_gain": round(REPLAYGAIN_REFERENCE_LUFS - loudness["integrated"], 2),
+                "track_peak": round(loudness["peak"], 6),
+                "version": version
+            }}
+        )
+        await song_catalog.reload({"content_hash": content_hash})
+    albums = {
+        (song.get("artist"), song.get("album"))
+        async for song in db.songs.find({"content_hash": content_hash}, {"artist": 1, "album": 1})
+    }
+    for artist, album in albums:
+        await update_album_gain(artist, album)
+
+
+async def update_album_gain(artist: str, album: str):
+    """Recompute album gain and peak over all analyzed tracks of an album"""
+    if not album or album == "Unknown Album":
+        return
+    tracks = await db.songs.find(
+        {"artist": artist, "album": album, "track_gain": {"$ne": None}},
+        {"content_hash": 1, "track_peak": 1}
+    ).to_list(None)
+    query = {"artist": artist, "album": album}
+    if tracks:
+        content_hashes = sorted({track["content_hash"] for track in tracks})
+        integrated = await anyio.to_thread.run_sync(album_loudness, content_hashes)
+        if integrated is None:
+            return
+        gains = {
+            "album_gain": round(REPLAYGAIN_REFERENCE_LUFS - integrated, 2),
+            "album_peak": max(track.get("track_peak") or 0.0 for track in tracks),
+        }
+    else:
+        # No analyzed tracks are left, so a stored album gain is stale
+        if not await db.songs.find_one({**query, "album_gain": {"$ne": None}}, {"_id": 1}):
+            return
+        gains = {"album_gain": None, "album_peak": None}
+    async with library_version.change() as version:
+        await db.songs.update_many(query, {"$set": {**gains, "version": version}})
+        await song_catalog.reload(query)
+
+
+async def delete_songs(song_ids: List[str]) -> int:
+    """Delete songs, keeping tombstones for ?since= delta listings"""
+    async with library_version.change() as version:
+        result = await db.songs.delete_many({"id": {"$in": song_ids}})
+        await db.song_deletions.insert_many([{"id": song_id, "version": version} for song_id in song_ids])
+        song_catalog.remove(song_ids)
+    event_hub.publish("songs_removed", {"version": version, "ids": song_ids})
+    return result.deleted_count
+
+
+async def on_songs_added(songs: List[dict], analyze: bool = True):
+    """Bookkeeping after new songs have been inserted"""
+    for song in songs:
+        search_index.add(song)
+        if analyze:
+            run_in_background(analyze_loudness(song["file_path"], song["content_hash"]))
+    song_catalog.upsert(songs)
+    if songs:
+        event_hub.publish("songs_added", {
+            "songs": [{key: value for key, value in song.items() if key != "_id"} for song in songs]
+        })
+    stats_snapshot.songs_added(songs)
+
+
+def walk_library(directories: List[Path]) -> List[Tuple[str, float, int]]:
+    """List (path, mtime, size) for every audio file under the library directories"""
+    found = []
+    for directory in directories:
+        for root, _, filenames in os.walk(directory):
+            for filename in filenames:
+                if Path(filename).suffix.lower() not in AUDIO_EXTENSIONS:
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found.append((path, stat.st_mtime, stat.st_size))
+    return found
+
+
+scan_status = {"running": False}
+
+
+async def scan_library():
+    """Import audio files in place from LIBRARY_DIRS, re-parsing only changed files
+
+    Files are matched to songs by path; unchanged (mtime, size) pairs are
+    skipped and songs whose files disappeared are removed. Changed files
+    lose their ReplayGain values until they are analyzed again, and the
+    album gains of the albums they left or joined are recomputed.
+    """
+    scan_status.update(running=True, started_at=datetime.utcnow(), finished_at=None,
+                       scanned=0, added=0, updated=0, removed=0, unchanged=0, errors=0)
+    try:
+        known = {}
+        projection = {"id": 1, "file_path": 1, "file_mtime": 1, "file_size": 1, "artist": 1, "album": 1}
+        async for song in db.songs.find({"source": "library"}, projection):
+            known[song["file_path"]] = song
+        
+        found = await anyio.to_thread.run_sync(walk_library, LIBRARY_DIRS)
+        scan_status["scanned"] = len(found)
+        changed = []
+        for path, mtime, size in found:
+            song = known.pop(path, None)
+            if song and song.get("file_mtime") == mtime and song.get("file_size") == size:
+                scan_status["unchanged"] += 1
+            else:
+                changed.append((path, mtime, size, song))
+        
+        semaphore = asyncio.Semaphore(METADATA_WORKERS * 2)
+        albums = set()
+        
+        async def parse(path: str, mtime: float, size: int) -> Tuple[str, dict]:
+            # In-place files are keyed by path and version instead of a full content hash
+            content_key = hashlib.sha256(f"{path}\0{size}\0{mtime}".encode("utf-8")).hexdigest()
+            async with semaphore:
+                return content_key, await extract_metadata_async(path, content_key)
+        
+        for start in range(0, len(changed), SCAN_BATCH_SIZE):
+            batch = changed[start:start + SCAN_BATCH_SIZE]
+            parsed = await asyncio.gather(*(parse(path, mtime, size) for path, mtime, size, _ in batch),
+                                          return_exceptions=True)
+            async with library_version.change() as version:
+                operations = []
+                songs = []
+                updated = []
+                for (path, mtime, size, existing), result in zip(batch, parsed):
+                    if isinstance(result, BaseException):
+                        logging.error(f"Error scanning {path}: {result}")
+                        scan_status["errors"] += 1
+                        continue
+                    content_key, metadata = result
+                    fields = {
+                        "title": metadata.get('title') or Path(path).stem,
+                        "artist": metadata.get('artist') or "Unknown Artist",
+                        "album": metadata.get('album') or "Unknown Album",
+                        "duration": metadata.get('duration', 0.0),
+                        "file_size": size,
+                        "file_mtime": mtime,
+                        "mime_type": mimetypes.guess_type(path)[0] or "application/octet-stream",
+                        "content_hash": content_key,
+                        "artwork_id": metadata.get('artwork_id'),
+                        "version": version,
+                    }
+                    if existing:
+                        # The gains were measured on the old file contents
+                        fields.update(track_gain=None, track_peak=None, album_gain=None, album_peak=None)
+                        albums.add((existing.get("artist"), existing.get("album")))
+                        albums.add((fields["artist"], fields["album"]))
+                        operations.append(UpdateOne({"id": existing["id"]}, {"$set": fields}))
+                        search_index.add({"id": existing["id"], **fields})
+                        updated.append({"id": existing["id"], **fields})
+                        scan_status["updated"] += 1
+                    else:
+                        song = Song(file_path=path, source="library", **fields).dict()
+                        operations.append(UpdateOne({"file_path": path, "source": "library"},
+                                                    {"$setOnInsert": song}, upsert=True))
+                        songs.append(song)
+                        scan_status["added"] += 1
+                if operations:
+                    await db.songs.bulk_write(operations, ordered=False)
+                if updated:
+                    await song_catalog.reload({"id": {"$in": [song["id"] for song in updated]}})
+                await on_songs_added(songs, analyze=False)
+            if updated:
+                event_hub.publish("songs_updated", {"songs": updated})
+        
+        # Prune songs whose files are gone
+        missing = [song["id"] for song in known.values()]
+        for start in range(0, len(missing), SCAN_BATCH_SIZE):
+            batch = missing[start:start + SCAN_BATCH_SIZE]
+            scan_status["removed"] += await delete_songs(batch)
+            for song_id in batch:
+                search_index.remove(song_id)
+        if missing:
+            await stats_snapshot.refresh()
+        albums.update((song.get("artist"), song.get("album")) for song in known.values())
+        for artist, album in albums:
+            await update_album_gain(artist, album)
+    except Exception as e:
+        logging.error(f"Error scanning library: {e}")
+        scan_status["error"] = str(e)
+    finally:
+        scan_status.update(running=False, finished_at=datetime.utcnow())
+
+
+async def receive_uploads(request: Request, field: str, single: bool = False) -> List[dict]:
+    """Stream the file parts of a multipart upload straight to staging files
+
+    The body is parsed as it arrives, so each file is hashed and checked
+    against MAX_UPLOAD_SIZE while it is still being received and written to
+    disk only once. Returns a dict per ``field`` file part with ``filename``
+    and ``content_type``, plus either ``path``, ``size`` and ``hash`` of the
+    staged file (in UPLOAD_DIR, ready for an atomic rename) or
+    ``status_code`` and ``error``. With ``single`` only one file is taken
+    and a rejected file raises instead.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+    content_length = request.headers.get("content-length", "")
+    if single and content_length.isdigit() and int(content_length) > MAX_UPLOAD_SIZE + MULTIPART_OVERHEAD:
+        raise HTTPException(status_code=413, detail=f"File exceeds maximum upload size of {MAX_UPLOAD_SIZE} bytes")
+    
+    # Parser callbacks are synchronous; queue what they see and act on it after each chunk
+    events = []
+    header = [b"", b""]
+    headers = {}
+    
+    def on_header_field(data: bytes, start: int, end: int):
+        header[0] += data[start:end]
+    
+    def on_header_value(data: bytes, start: int, end: int):
+        header[1] += data[start:end]
+    
+    def on_header_end():
+        headers[header[0].lower()] = header[1]
+        header[:] = [b"", b""]
+    
+    def on_headers_finished():
+        events.append(("begin", dict(headers)))
+        headers.clear()
+    
+    parser = MultipartParser(boundary, {
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+        "on_part_end": lambda: events.append(("end", None)),
+    })
+    
+    parts = []
+    part = None
+    f = None
+    
+    async def reject(status_code: int, detail: str):
+        nonlocal f
+        if f is not None:
+            await f.close()
+            f = None
+            part.pop("path").unlink()
+        if single:
+            raise HTTPException(status_code=status_code, detail=detail)
+        part.update(status_code=status_code, error=detail)
+    
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for event, value in events:
+                if event == "begin":
+                    _, disposition = parse_options_header(value.get(b"content-disposition", b""))
+                    filename = disposition.get(b"filename")
+                    if disposition.get(b"name") != field.encode() or filename is None or (single and parts):
+                        part = None
+                        continue
+                    if len(parts) >= MAX_UPLOAD_FILES:
+                        raise HTTPException(status_code=400, detail=f"Too many files; the limit is {MAX_UPLOAD_FILES}")
+                    part = {
+                        "filename": filename.decode("utf-8", "replace"),
+                        "content_type": value.get(b"content-type", b"").decode("latin-1")
+                    }
+                    parts.append(part)
+                    if not part["content_type"].startswith('audio/'):
+                        await reject(400, "File must be an audio file")
+                        continue
+                    part.update(path=UPLOAD_DIR / f".{uuid.uuid4()}.part", size=0, digest=hashlib.sha256())
+                    f = await aiofiles.open(part["path"], 'wb')
+                elif part is None or "error" in part:
+                    continue
+                elif event == "data":
+                    part["size"] += len(value)
+                    upload_bytes_received.inc(len(value))
+                    if part["size"] > MAX_UPLOAD_SIZE:
+                        await reject(413, f"File exceeds maximum upload size of {MAX_UPLOAD_SIZE} bytes")
+                        continue
+                    part["digest"].update(value)
+                    await f.write(value)
+                else:
+                    await f.close()
+                    f = None
+                    part["hash"] = part.pop("digest").hexdigest()
+            events.clear()
+        parser.finalize()
+        if f is not None:
+            raise HTTPException(status_code=400, detail="Upload ended before the file was complete")
+    except BaseException:
+        if f is not None:
+            await f.close()
+        for staged in parts:
+            if "path" in staged and staged["path"].exists():
+                staged["path"].unlink()
+        raise
+    
+    if single and not parts:
+        raise HTTPException(status_code=400, detail=f"No file in the '{field}' field")
+    return parts
+
+
+async def store_blob(temp_path: Path, content_hash: str, file_extension: str) -> dict:
+    """Move a staged upload into content-addressed storage and take a reference
+
+    If a blob with the same hash already exists the staged file is discarded
+    and the stored blob (including its cached metadata) is reused.
+    """
+    blob = await db.blobs.find_one_and_update(
+        {"hash": content_hash},
+        {"$inc": {"ref_count": 1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob:
+        temp_path.unlink()
+        return blob
+    
+    blob_path = UPLOAD_DIR / f"{content_hash}{file_extension}"
+    try:
+        os.replace(temp_path, blob_path)
+        metadata = await extract_metadata_async(str(blob_path), content_hash)
+    except BaseException:
+        if temp_path.exists():
+            temp_path.unlink()
+        elif not await db.blobs.find_one({"hash": content_hash}, {"_id": 1}):
+            # Moved but never recorded; unless a concurrent upload of the same content registered it
+            blob_path.unlink(missing_ok=True)
+        raise
+    schedule_analysis("waveform", compute_waveform, str(blob_path), content_hash)
+    run_in_background(analyze_features(str(blob_path), content_hash))
+    
+    # Upsert so that concurrent first uploads of the same content share one record
+    return await db.blobs.find_one_and_update(
+        {"hash": content_hash},
+        {
+            "$inc": {"ref_count": 1},
+            "$setOnInsert": {
+                "file_path": str(blob_path),
+                "file_size": blob_path.stat().st_size,
+                "metadata": metadata,
+                "created_at": datetime.utcnow()
+            }
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def release_blob(content_hash: str):
+    """Drop a reference to a stored blob, deleting it once unreferenced"""
+    blob = await db.blobs.find_one_and_update(
+        {"hash": content_hash},
+        {"$inc": {"ref_count": -1}},
+        return_document=ReturnDocument.AFTER
+    )
+    if blob and blob["ref_count"] <= 0:
+        result = await db.blobs.delete_one({"hash": content_hash, "ref_count": {"$lte": 0}})
+        if result.deleted_count:
+            Path(blob["file_path"]).unlink(missing_ok=True)
+
+
+def upload_session_path(session_id: str) -> Path:
+    return UPLOAD_DIR / f".{session_id}.upload"
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def backfill_content_hash(song_id: str, file_path: str) -> Optional[str]:
+    """Hash and store the content of a song uploaded before content addressing"""
+    try:
+        content_hash = await anyio.to_thread.run_sync(hash_file, Path(file_path))
+    except OSError as e:
+        logging.error(f"Error hashing {file_path}: {e}")
+        return None
+    async with library_version.change() as version:
+        await db.songs.update_one(
+            {"id": song_id, "content_hash": {"$in": [None, ""]}},
+            {"$set": {"content_hash": content_hash, "version": version}}
+        )
+        await song_catalog.reload({"id": song_id})
+    return content_hash
+
+
+async def analyze_song_loudness(song_id: str, file_path: str, content_hash: Optional[str]):
+    """Analyze a song's loudness, hashing it first if it predates content addressing"""
+    content_hash = content_hash or await backfill_content_hash(song_id, file_path)
+    if content_hash:
+        await analyze_loudness(file_path, content_hash)
+
+
+async def get_upload_session(session_id: str) -> Tuple[dict, int]:
+    """Look up a live resumable upload session and its current offset
+
+    The offset is the size of the staging file, so bytes that reached disk
+    before a dropped connection are kept.
+    """
+    session = await db.upload_sessions.find_one({"id": session_id, "expires_at": {"$gt": datetime.utcnow()}})
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    path = upload_session_path(session_id)
+    return session, path.stat().st_size if path.exists() else 0
+
+
+def upload_session_status(session: dict, offset: int) -> dict:
+    return {
+        "id": session["id"],
+        "filename": session["filename"],
+        "offset": offset,
+        "length": session["length"],
+        "expires_at": session["expires_at"]
+    }
+
+
+async def delete_upload_session(session_id: str):
+    await db.upload_sessions.delete_one({"id": session_id})
+    upload_session_path(session_id).unlink(missing_ok=True)
+
+
+async def expire_upload_sessions():
+    """Periodically discard upload sessions that have been idle past their TTL"""
+    while True:
+        try:
+            async for session in db.upload_sessions.find({"expires_at": {"$lte": datetime.utcnow()}}, {"id": 1}):
+                if session["id"] not in uploads_in_progress:
+                    await delete_upload_session(session["id"])
+        except Exception as e:
+            logging.error(f"Error expiring upload sessions: {e}")
+        await asyncio.sleep(UPLOAD_SESSION_SWEEP_INTERVAL)
+
+
+uploads_in_progress = set()
+upload_expiry_task: Optional[asyncio.Task] = None
+
+
+SONG_DEFAULTS = {
+    name: field.default
+    for name, field in Song.model_fields.items()
+    if not field.is_required() and field.default_factory is None
+}
+
+
+async def iterate(items):
+    """Iterate a Motor cursor or an already fetched list uniformly"""
+    if isinstance(items, list):
+        for item in items:
+            yield item
+    else:
+        async for item in items:
+            yield item
+
+
+def json_default(value):
+    """JSON encoder fallback matching FastAPI's encoding of Mongo documents"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_song(song: dict, projected: bool = False) -> str:
+    """Serialize a raw song document to JSON without building a Song model"""
+    if not projected:
+        for name, default in SONG_DEFAULTS.items():
+            song.setdefault(name, default)
+    return json.dumps(song, default=json_default)
+
+
+def encode_cursor(song: dict, sort: str) -> str:
+    """Build an opaque keyset cursor from the last document of a page"""
+    token = json_util.dumps([song.get(sort), song["id"]])
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[object, str]:
+    """Recover the (sort value, id) pair from a keyset cursor"""
+    try:
+        value, last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, last_id
+
+
+def cursor_filter(cursor: str, sort: str, descending: bool) -> dict:
+    """Translate a keyset cursor into a filter selecting the following documents"""
+    value, last_id = decode_cursor(cursor)
+    
+    # Missing/null values sort before everything else in MongoDB
+    compare = "$lt" if descending else "$gt"
+    if value is None:
+        after = [{sort: None, "id": {compare: last_id}}]
+        if not descending:
+            after.append({sort: {"$ne": None}})
+    else:
+        after = [{sort: {compare: value}}, {sort: value, "id": {compare: last_id}}]
+        if descending:
+            after.append({sort: None})
+    return {"$or": after}
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def catalog_key(field: str, value) -> object:
+    """Sortable column value ordered like MongoDB orders the stored field
+
+    Text sorts by code point, dates as whole milliseconds (MongoDB's
+    precision) and missing values before everything else.
+    """
+    if field in CATALOG_TEXT_FIELDS:
+        return value or ""
+    if value is None:
+        return -np.inf
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return float((value - EPOCH) // timedelta(milliseconds=1))
+    return float(value)
+
+
+class SongRecord:
+    """One catalog row: a song id and its JSON, encoded once per change"""
+
+    __slots__ = ("id", "json")
+
+    def __init__(self, song_id: str, json_text: str):
+        self.id = song_id
+        self.json = json_text
+
+
+class SongCatalog:
+    """Array-backed in-memory copy of the songs collection for listings
+
+    Sort fields, the favorite flag and ids are held in columns indexed by
+    row, next to a list of SongRecords. Sort orders are computed once per
+    field and then repaired in place as rows change, so a listing is a
+    vectorized filter over a cached permutation plus a join of pre-encoded
+    JSON. Deleted rows are recycled through a free list.
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.records: List[Optional[SongRecord]] = []
+        self.free = []
+        self.ids = np.empty(0, dtype=object)
+        self.favorite = np.empty(0, dtype=bool)
+        self.alive = np.empty(0, dtype=bool)
+        self.columns = {
+            field: np.empty(0, dtype=object if field in CATALOG_TEXT_FIELDS else np.float64)
+            for field in SONG_SORT_FIELDS
+        }
+        self.id_order = None
+        self.orders = {}
+        self.loaded = False
+
+    def allocate(self) -> int:
+        if self.free:
+            return self.free.pop()
+        row = len(self.records)
+        self.records.append(None)
+        if row == len(self.alive):
+            capacity = max(64, 2 * len(self.alive))
+            
+            def grow(column: np.ndarray) -> np.ndarray:
+                grown = np.zeros(capacity, dtype=column.dtype)
+                grown[:row] = column
+                return grown
+            
+            self.ids, self.favorite, self.alive = grow(self.ids), grow(self.favorite), grow(self.alive)
+            self.columns = {field: grow(column) for field, column in self.columns.items()}
+        return row
+
+    def upsert(self, songs: List[dict]):
+        """Add or replace songs from complete documents"""
+        added = set()
+        moved = {field: set() for field in self.orders}
+        for song in songs:
+            song = {key: value for key, value in song.items() if key != "_id"}
+            row = self.rows.get(song["id"])
+            if row is None:
+                row = self.rows[song["id"]] = self.allocate()
+                added.add(row)
+            self.records[row] = SongRecord(song["id"], encode_song(song))
+            self.ids[row] = song["id"]
+            self.favorite[row] = bool(song.get("is_favorite"))
+            self.alive[row] = True
+            for field, column in self.columns.items():
+                key = catalog_key(field, song.get(field))
+                if field in moved and (row in added or column[row] != key):
+                    moved[field].add(row)
+                column[row] = key
+        
+        # Only rows whose sort key changed need to move in each cached order
+        if added and self.id_order is not None:
+            self.id_order = self.repair(self.id_order, added, lambda row: self.ids[row])
+        for field, rows in moved.items():
+            if not rows:
+                continue
+            column = self.columns[field]
+            order = self.repair(self.orders[field], rows, lambda row: (column[row], self.ids[row]))
+            if order is None:
+                del self.orders[field]
+            else:
+                self.orders[field] = order
+
+    def repair(self, order: np.ndarray, rows: set, key) -> Optional[np.ndarray]:
+        """Move ``rows`` to their sorted positions in a cached order, or None if too many changed"""
+        if len(rows) > CATALOG_REPAIR_ROWS:
+            return None
+        rows = sorted(rows, key=key)
+        kept = order[~self.row_mask(rows)[order]]
+        positions = [bisect.bisect_left(kept, key(row), key=key) for row in rows]
+        return np.insert(kept, positions, rows)
+
+    def row_mask(self, rows) -> np.ndarray:
+        mask = np.zeros(len(self.alive), dtype=bool)
+        mask[list(rows)] = True
+        return mask
+
+    def remove(self, song_ids: List[str]):
+        removed = []
+        for song_id in song_ids:
+            row = self.rows.pop(song_id, None)
+            if row is None:
+                continue
+            self.records[row] = None
+            self.alive[row] = False
+            self.free.append(row)
+            removed.append(row)
+        if removed:
+            mask = self.row_mask(removed)
+            if self.id_order is not None:
+                self.id_order = self.id_order[~mask[self.id_order]]
+            self.orders = {field: order[~mask[order]] for field, order in self.orders.items()}
+
+    async def reload(self, query: dict):
+        """Refresh the songs matching ``query`` after an update in the database"""
+        self.upsert(await db.songs.find(query, {"_id": 0}).to_list(None))
+
+    async def load(self):
+        self.__init__()
+        batch = []
+        async for song in db.songs.find({}, {"_id": 0}):
+            batch.append(song)
+            if len(batch) >= SCAN_BATCH_SIZE:
+                self.upsert(batch)
+                batch = []
+        self.upsert(batch)
+        self.loaded = True
+
+    def order(self, field: str) -> np.ndarray:
+        """Live rows ascending by (field, id), built from the cached id order"""
+        order = self.orders.get(field)
+        if order is None:
+            if self.id_order is None:
+                rows = np.flatnonzero(self.alive[:len(self.records)])
+                self.id_order = rows[np.argsort(self.ids[rows], kind="stable")]
+            rows = self.id_order
+            order = self.orders[field] = rows[np.argsort(self.columns[field][rows], kind="stable")]
+        return order
+
+    def query(self, sort: str, descending: bool, favorite: Optional[bool] = None,
+              after: Optional[Tuple[object, str]] = None, limit: Optional[int] = None) -> List[SongRecord]:
+        """Records in listing order; with ``limit``, up to one extra to signal another page"""
+        order = self.order(sort)
+        column = self.columns[sort]
+        if after is not None:
+            key = (catalog_key(sort, after[0]), after[1])
+            row_key = lambda row: (column[row], self.ids[row])
+            if descending:
+                order = order[:bisect.bisect_left(order, key, key=row_key)]
+            else:
+                order = order[bisect.bisect_right(order, key, key=row_key):]
+        if descending:
+            order = order[::-1]
+        if favorite is not None:
+            order = order[self.favorite[order] == favorite]
+        if limit:
+            order = order[:limit + 1]
+        return [self.records[row] for row in order]
+
+    def cursor(self, record: SongRecord, sort: str) -> str:
+        """Keyset cursor after ``record``, valid for both catalog and database listings"""
+        value = self.columns[sort][self.rows[record.id]]
+        if sort not in CATALOG_TEXT_FIELDS:
+            if value == -np.inf:
+                value = None
+            elif sort in CATALOG_TIME_FIELDS:
+                value = EPOCH + timedelta(milliseconds=value)
+            else:
+                value = float(value)
+        return encode_cursor({sort: value, "id": record.id}, sort)
+
+
+song_catalog = SongCatalog()
+
+
+# API Routes
+@api_router.get("/")
+async def root():
+    return {"message": "Music Player API"}
+
+async def ingest_staged(temp_path: Path, content_hash: str, filename: str, content_type: str) -> Song:
+    """Resolve a staged upload to a content-addressed blob and build its Song"""
+    try:
+        blob = await store_blob(temp_path, content_hash, Path(filename).suffix.lower())
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
+    
+    metadata = blob.get("metadata", {})
+    return Song(
+        title=metadata.get('title') or Path(filename).stem,
+        artist=metadata.get('artist') or "Unknown Artist",
+        album=metadata.get('album') or "Unknown Album",
+        duration=metadata.get('duration', 0.0),
+        file_path=blob["file_path"],
+        file_size=blob["file_size"],
+        mime_type=content_type,
+        content_hash=content_hash,
+        artwork_id=metadata.get('artwork_id')
+    )
+
+async def create_song(song: Song) -> Song:
+    """Insert an ingested song, releasing its blob reference on failure"""
+    try:
+        async with library_version.change() as version:
+            song.version = version
+            await db.songs.insert_one(song.dict())
+            await on_songs_added([song.dict()])
+    except Exception as e:
+        if not await db.songs.find_one({"id": song.id}, {"_id": 1}):
+            await release_blob(song.content_hash)
+        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
+    return song
+
+@api_router.post("/songs/upload")
+async def upload_song(request: Request):
+    """Upload a music file as the ``file`` field of a multipart form"""
+    upload = (await receive_uploads(request, "file", single=True))[0]
+    return await create_song(
+        await ingest_staged(upload["path"], upload["hash"], upload["filename"], upload["content_type"])
+    )
+
+@api_router.post("/uploads", status_code=201)
+async def create_upload_session(upload: UploadSessionCreate, response: Response):
+    """Start a resumable upload of ``length`` bytes
+
+    Send the bytes with PUT /uploads/{id} and an ``Upload-Offset`` header,
+    check progress with GET /uploads/{id} after an interruption, and create
+    the song with POST /uploads/{id}/finalize once every byte has arrived.
+    """
+    if not upload.content_type.startswith('audio/'):
+        raise HTTPException(status_code=400, detail="File must be an audio file")
+    if upload.length > MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File exceeds maximum upload size of {MAX_UPLOAD_SIZE} bytes"
+        )
+    now = datetime.utcnow()
+    session = {
+        "id": str(uuid.uuid4()),
+        "filename": upload.filename,
+        "content_type": upload.content_type,
+        "length": upload.length,
+        "created_at": now,
+        "expires_at": now + UPLOAD_SESSION_TTL
+    }
+    await db.upload_sessions.insert_one(session)
+    upload_session_path(session["id"]).touch()
+    response.headers["Location"] = f"{api_router.prefix}/uploads/{session['id']}"
+    response.headers["Upload-Offset"] = "0"
+    return upload_session_status(session, 0)
+
+@api_router.get("/uploads/{session_id}")
+async def get_upload_status(session_id: str, response: Response):
+    """Report how many bytes of a resumable upload have been received"""
+    session, offset = await get_upload_session(session_id)
+    response.headers["Upload-Offset"] = str(offset)
+    response.headers["Cache-Control"] = "no-store"
+    return upload_session_status(session, offset)
+
+@api_router.put("/uploads/{session_id}", status_code=204)
+async def upload_chunk(session_id: str, request: Request, upload_offset: int = Header(..., ge=0)):
+    """Append the request body to a resumable upload at ``Upload-Offset``"""
+    if session_id in uploads_in_progress:
+        raise HTTPException(status_code=409, detail="Another chunk is being uploaded to this session")
+    uploads_in_progress.add(session_id)
+    try:
+        session, offset = await get_upload_session(session_id)
+        if upload_offset != offset:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload offset mismatch: expected {offset}",
+                headers={"Upload-Offset": str(offset)}
+            )
+        
+        received = 0
+        path = upload_session_path(session_id)
+        path.touch(exist_ok=True)
+        try:
+            async with aiofiles.open(path, 'r+b') as f:
+                await f.seek(offset)
+                async for chunk in request.stream():
+                    if offset + received + len(chunk) > session["length"]:
+                        raise HTTPException(status_code=413, detail="Chunk exceeds the declared upload length")
+                    await f.write(chunk)
+                    received += len(chunk)
+                    upload_bytes_received.inc(len(chunk))
+        finally:
+            # Whatever reached the staging file counts; the client resumes from there
+            await db.upload_sessions.update_one(
+                {"id": session_id},
+                {"$set": {"expires_at": datetime.utcnow() + UPLOAD_SESSION_TTL}}
+            )
+        return Response(status_code=204, headers={"Upload-Offset": str(offset + received)})
+    finally:
+        uploads_in_progress.discard(session_id)
+
+@api_router.post("/uploads/{session_id}/finalize")
+async def finalize_upload(session_id: str):
+    """Create the song from a completely received resumable upload"""
+    if session_id in uploads_in_progress:
+        raise HTTPException(status_code=409, detail="A chunk is still being uploaded to this session")
+    uploads_in_progress.add(session_id)
+    try:
+        session, offset = await get_upload_session(session_id)
+        if offset != session["length"]:
+            raise HTTPException(
+                status_code=409,
+                detail=f"Upload incomplete: received {offset} of {session['length']} bytes",
+                headers={"Upload-Offset": str(offset)}
+            )
+        
+        # The staging file lives in UPLOAD_DIR, so the blob store can rename it into place
+        staged_path = upload_session_path(session_id)
+        content_hash = await anyio.to_thread.run_sync(hash_file, staged_path)
+        song = await ingest_staged(staged_path, content_hash, session["filename"], session["content_type"])
+        await db.upload_sessions.delete_one({"id": session_id})
+    finally:
+        uploads_in_progress.discard(session_id)
+    return await create_song(song)
+
+@api_router.delete("/uploads/{session_id}")
+async def abort_upload(session_id: str):
+    """Abandon a resumable upload and discard the bytes received so far"""
+    if session_id in uploads_in_progress:
+        raise HTTPException(status_code=409, detail="A chunk is still being uploaded to this session")
+    await get_upload_session(session_id)
+    await delete_upload_session(session_id)
+    return {"message": "Upload session deleted"}
+
+@api_router.post("/songs/upload/batch")
+async def upload_songs_batch(request: Request):
+    """Upload several music files in one request, as ``files`` fields of a multipart form"""
+    semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+    
+    async def ingest(upload: dict) -> dict:
+        filename = upload["filename"]
+        if "error" in upload:
+            return {"filename": filename, "status_code": upload["status_code"], "error": upload["error"]}
+        async with semaphore:
+            try:
+                song = await ingest_staged(upload["path"], upload["hash"], filename, upload["content_type"])
+                return {"filename": filename, "status_code": 200, "song": song}
+            except HTTPException as e:
+                return {"filename": filename, "status_code": e.status_code, "error": e.detail}
+            except Exception as e:
+                return {"filename": filename, "status_code": 500, "error": f"Error uploading file: {str(e)}"}
+    
+    results = await asyncio.gather(*(ingest(upload) for upload in await receive_uploads(request, "files")))
+    
+    # Write all new songs in a single unordered bulk insert
+    ingested = [result for result in results if "song" in result]
+    if ingested:
+        async with library_version.change() as version:
+            for result in ingested:
+                result["song"].version = version
+            try:
+                await db.songs.insert_many([result["song"].dict() for result in ingested], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    result = ingested[error["index"]]
+                    await release_blob(result["song"].content_hash)
+                    result.pop("song")
+                    result.update(status_code=500, error=f"Error uploading file: {error.get('errmsg')}")
+            await on_songs_added([result["song"].dict() for result in ingested if "song" in result])
+    
+    return {
+        "uploaded": sum(1 for result in results if "song" in result),
+        "failed": sum(1 for result in results if "song" not in result),
+        "results": results
+    }
+
+@api_router.post("/songs/loudness/analyze")
+async def analyze_library_loudness():
+    """Queue loudness analysis for every song without ReplayGain values"""
+    queued = set()
+    async for song in db.songs.find({"track_gain": None}, {"id": 1, "file_path": 1, "content_hash": 1}):
+        content_hash = song.get("content_hash")
+        if content_hash in queued or ("loudness", content_hash) in analysis_unavailable:
+            continue
+        if not Path(song["file_path"]).exists():
+            continue
+        # Songs without a hash are hashed in the background before analysis
+        queued.add(content_hash or song["id"])
+        run_in_background(analyze_song_loudness(song["id"], song["file_path"], content_hash))
+    return {"queued": len(queued)}
+
+@api_router.post("/library/scan", status_code=202)
+async def start_library_scan():
+    """Scan the configured library directories for new, changed and deleted files"""
+    if not LIBRARY_DIRS:
+        raise HTTPException(status_code=400, detail="No library directories configured (LIBRARY_DIRS)")
+    if not scan_status["running"]:
+        scan_status["running"] = True
+        run_in_background(scan_library())
+    return scan_status
+
+@api_router.get("/library/scan")
+async def get_library_scan():
+    """Get the progress of the current or last library scan"""
+    return scan_status
+
+@api_router.get("/songs")
+async def get_songs(
+    request: Request,
+    since: Optional[int] = Query(None, ge=0),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    sort: str = "date_added",
+    order: str = "asc",
+    favorite: Optional[bool] = None,
+    fields: Optional[str] = None,
+    format: str = "json"
+):
+    """Get songs, optionally filtered by favorite and paginated by keyset cursor
+
+    Full documents are served from the in-memory song catalog; a ``fields``
+    projection is streamed straight from the Mongo cursor. With ``limit``
+    one page is returned and the cursor for the next page is sent in the
+    ``X-Next-Cursor`` header. ``format=ndjson`` emits one document per line.
+
+    ``since`` returns only what changed after that library version, as
+    ``{"version", "deleted", "songs"}``. Responses carry a weak ETag derived
+    from the library version, and a matching If-None-Match gets a 304.
+    """
+    etag = library_version.etag(request)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    if since is not None:
+        return await get_songs_since(since, etag)
+
+    if sort not in SONG_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Cannot sort by {sort}")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="Order must be asc or desc")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="Format must be json or ndjson")
+    names = [name.strip() for name in fields.split(",") if name.strip()] if fields else []
+    unknown = [name for name in names if name not in Song.model_fields]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    descending = order == "desc"
+    headers = {"ETag": etag}
+    media_type = "application/json" if format == "json" else "application/x-ndjson"
+    
+    if not names and song_catalog.loaded:
+        records = song_catalog.query(sort, descending, favorite, decode_cursor(cursor) if cursor else None, limit)
+        if limit and len(records) > limit:
+            records = records[:limit]
+            headers["X-Next-Cursor"] = song_catalog.cursor(records[-1], sort)
+        
+        def generate_records():
+            for start in range(0, len(records), SCAN_BATCH_SIZE):
+                batch = records[start:start + SCAN_BATCH_SIZE]
+                if format == "json":
+                    yield ("[" if not start else ",") + ",".join(record.json for record in batch)
+                else:
+                    yield "".join(record.json + "\n" for record in batch)
+            if format == "json":
+                yield "]" if records else "[]"
+        
+        return StreamingResponse(generate_records(), media_type=media_type, headers=headers)
+    
+    projection = {"_id": 0}
+    if names:
+        projection.update({name: 1 for name in names})
+        projection.update({"id": 1, sort: 1})
+    
+    query = cursor_filter(cursor, sort, descending) if cursor else {}
+    if favorite is not None:
+        query["is_favorite"] = favorite
+    direction = -1 if descending else 1
+    songs = db.songs.find(query, projection).sort([(sort, direction), ("id", direction)])
+    
+    if limit:
+        page = await songs.limit(limit + 1).to_list(limit + 1)
+        if len(page) > limit:
+            page = page[:limit]
+            headers["X-Next-Cursor"] = encode_cursor(page[-1], sort)
+        songs = page
+    
+    async def generate():
+        first = True
+        if format == "json":
+            yield "["
+        async for song in iterate(songs):
+            if format == "json":
+                yield ("" if first else ",") + encode_song(song, bool(names))
+            else:
+                yield encode_song(song, bool(names)) + "\n"
+            first = False
+        if format == "json":
+            yield "]"
+    
+    return StreamingResponse(generate(), media_type=media_type, headers=headers)
+
+async def get_songs_since(since: int, etag: str) -> StreamingResponse:
+    """Stream songs changed and ids deleted after a library version"""
+    # Read the version first so concurrent changes are repeated, never missed
+    version = library_version.value
+    deleted = await db.song_deletions.distinct("id", {"version": {"$gt": since}})
+    songs = db.songs.find({"version": {"$gt": since}}, {"_id": 0}).sort("version", 1)
+    
+    async def generate():
+        yield json.dumps({"version": version, "deleted": deleted})[:-1] + ', "songs": ['
+        first = True
+        async for song in songs:
+            yield ("" if first else ",") + encode_song(song)
+            first = False
+        yield "]}"
+    
+    return StreamingResponse(generate(), media_type="application/json", headers={"ETag": etag})
+
+@api_router.get("/search")
+async def search_songs(q: str = Query(..., min_length=1), limit: int = Query(20, ge=1, le=100)):
+    """Search songs by title, artist and album"""
+    ranked = search_index.search(q, limit)
+    if not ranked:
+        return []
+    songs = await db.songs.find({"id": {"$in": [song_id for song_id, _ in ranked]}}, {"_id": 0}).to_list(limit)
+    songs_by_id = {song["id"]: song for song in songs}
+    return [Song(**songs_by_id[song_id]) for song_id, _ in ranked if song_id in songs_by_id]
+
+@api_router.get("/songs/{song_id}", response_model=Song)
+async def get_song(song_id: str):
+    """Get a specific song"""
+    song = await db.songs.find_one({"id": song_id})
+    if not song:
+        raise HTTPException(status_code=404, detail="Song not found")
+    return Song(**song)
+
+@api_router.get("/songs/{song_id}/stream")
+async def stream_song(request: Request, song_id: str, range: Optional[str] = Header(None),
+                      t: Optional[float] = Query(None, ge=0), next: Optional[str] = None,
+                      eq: bool = False):
+    """Stream a song file, honouring HTTP Range requests
+
+    ``t`` starts MP3 playback at the frame boundary for that many seconds,
+    using the seek index built at ingest; a Range then addresses the stream
+    from that frame on.
+    ``next`` is a comma-separated list of upcoming song ids to prefetch.
+    ``eq`` applies the stored equalizer bands server-side and streams WAV;
+    the first play is rendered on the fly, later ones come from the cache.
+    """
+    song = await db.songs.find_one({"id": song_id})
+    if not song:
+        raise HTTPException(status_code=404, detail="Song not found")
+    
+    file_path = Path(song["file_path"])
+    if not file_path.exists():
+        raise HTTPException(status_code=404, detail="Song file not found")
+    
+    file_stat = file_path.stat()
+    media_type = song["mime_type"] or "application/octet-stream"
+    headers = {}
+    upcoming = [i for i in (next or "").split(",") if i][:PREFETCH_TRACKS]
+    if upcoming:
+        run_in_background(prefetch_songs(upcoming))
+        headers["Link"] = preload_links(upcoming)
+    
+    bands = UserSettings(**(await db.settings.find_one() or {})).equalizer_bands if eq else []
+    if any(bands):
+        if t is not None:
+            raise HTTPException(status_code=400, detail="Time-based seeking is not available with the equalizer")
+        cache_path = equalizer_cache_path(song.get("content_hash") or song_id, bands)
+        try:
+            cache_stat = cache_path.stat()
+        except FileNotFoundError:
+            decoded = await anyio.to_thread.run_sync(decode_pcm, str(file_path))
+            if decoded is None:
+                raise HTTPException(status_code=415, detail="The equalizer is not available for this format")
+            record_play(request, song_id)
+            return StreamingResponse(render_equalized(decoded, bands, cache_path), media_type="audio/wav", headers=headers)
+        # Refresh the access time that cache pruning evicts by
+        os.utime(cache_path, (time.time(), cache_stat.st_mtime))
+        file_path, file_stat, media_type = cache_path, cache_stat, "audio/wav"
+    
+    file_size = file_stat.st_size
+    cache_key = f"{file_path}:{file_stat.st_mtime_ns}:{file_size}"
+    if t is not None:
+        seek = await seek_offset(song.get("content_hash"), t)
+        if seek is None:
+            raise HTTPException(status_code=400, detail="Time-based seeking is not available for this song")
+        offset, start_time = seek
+        return FileRangeResponse(
+            file_path,
+            file_size,
+            parse_range_header(range, file_size - offset),
+            offset=offset,
+            media_type=media_type,
+            headers={**headers, "X-Seek-Time": f"{start_time:.3f}", "X-Seek-Offset": str(offset)},
+            cache_key=cache_key
+        )
+    ranges = parse_range_header(range, file_size)
+    
+    # Count a play when playback starts; seeks and re-buffering resume mid-file
+    if not ranges or ranges[0][0] == 0:
+        record_play(request, song_id)
+    
+    return FileRangeResponse(
+        file_path,
+        file_size,
+        ranges,
+        media_type=media_type,
+        headers=headers,
+        cache_key=cache_key
+    )
+
+@api_router.post("/queue")
+async def update_queue(queue: QueueUpdate, response: Response):
+    """Declare upcoming tracks so their files are warmed before playback"""
+    warming, missing = await prefetch_songs(queue.song_ids)
+    if warming:
+        response.headers["Link"] = preload_links(warming)
+    return {"warming": warming, "missing": missing}
+
+@api_router.get("/songs/{song_id}/artwork")
+async def get_song_artwork(song_id: str, size: int = 256, if_none_match: Optional[str] = Header(None)):
+    """Get a song's album art as a pre-resized JPEG thumbnail"""
+    song = await db.songs.find_one({"id": song_id}, {"artwork_id": 1})
+    if not song:
+        raise HTTPException(status_code=404, detail="Song not found")
+    artwork_id = song.get("artwork_id")
+    if not artwork_id:
+        raise HTTPException(status_code=404, detail="Song has no artwork")
+    
+    # Serve the smallest stored size that covers the request
+    size = next((s for s in ARTWORK_SIZES if s >= size), ARTWORK_SIZES[-1])
+    etag = f'"{artwork_id[:32]}-{size}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable"
+    }
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    
+    data = artwork_cache.get((artwork_id, size))
+    if data is None:
+        artwork_path = ARTWORK_DIR / f"{artwork_id}_{size}.jpg"
+        if not artwork_path.exists():
+            raise HTTPException(status_code=404, detail="Artwork file not found")
+        async with aiofiles.open(artwork_path, 'rb') as f:
+            data = await f.read()
+        artwork_cache.put((artwork_id, size), data)
+    
+    return Response(content=data, media_type="image/jpeg", headers=headers)
+
+@api_router.get("/songs/{song_id}/waveform")
+async def get_song_waveform(song_id: str, buckets: int = Query(1000, ge=1, le=MAX_WAVEFORM_BUCKETS)):
+    """Get min/max waveform peaks for drawing a seekbar"""
+    song = await db.songs.find_one({"id": song_id}, {"file_path": 1, "content_hash": 1, "duration": 1})
+    if not song:
+        raise HTTPException(status_code=404, detail="Song not found")
+    content_hash = song.get("content_hash") or await backfill_content_hash(song_id, song["file_path"])
+    if not content_hash or ("waveform", content_hash) in analysis_unavailable:
+        raise HTTPException(status_code=404, detail="Waveform is not available for this song")
+    
+    peaks = await anyio.to_thread.run_sync(read_waveform, content_hash, buckets)
+    if peaks is None:
+        # Not computed yet (or still running): start the job and ask the client to retry
+        if not Path(song["file_path"]).exists():
+            raise HTTPException(status_code=404, detail="Song file not found")
+        schedule_analysis("waveform", compute_waveform, song["file_path"], content_hash)
+        return Response(status_code=202, headers={"Retry-After": "2"})
+    
+    return {
+        "buckets": len(peaks),
+        "duration": song.get("duration", 0.0),
+        "min": np.round(peaks[:, 0], 4).tolist(),
+        "max": np.round(peaks[:, 1], 4).tolist()
+    }
+
+@api_router.get("/songs/{song_id}/similar")
+async def get_similar_songs(song_id: str, limit: int = Query(20, ge=1, le=100)):
+    """Get songs that sound similar, for building a radio queue"""
+    song = await db.songs.find_one({"id": song_id}, {"file_path": 1, "content_hash": 1})
+    if not song:
+        raise HTTPException(status_code=404, detail="Song not found")
+    content_hash = song.get("content_hash") or await backfill_content_hash(song_id, song["file_path"])
+    if not content_hash or ("features", content_hash) in analysis_unavailable:
+        raise HTTPException(status_code=404, detail="Audio features are not available for this song")
+    
+    if content_hash not in feature_index.rows:
+        # Not analyzed yet: start the job and ask the client to retry
+        if not Path(song["file_path"]).exists():
+            raise HTTPException(status_code=404, detail="Song file not found")
+        if ("features", content_hash) not in analysis_jobs:
+            run_in_background(analyze_features(song["file_path"], content_hash))
+        return Response(status_code=202, headers={"Retry-After": "2"})
+    
+    # Several songs may share one blob; return one song per similar track
+    ranked = feature_index.similar(content_hash, limit)
+    songs = await db.songs.find(
+        {"content_hash": {"$in": [ranked_hash for ranked_hash, _ in ranked]}}, {"_id": 0}
+    ).to_list(None)
+    songs_by_hash = {}
+    for similar_song in songs:
+        songs_by_hash.setdefault(similar_song["content_hash"], similar_song)
+    return [
+        {"song": Song(**songs_by_hash[ranked_hash]), "similarity": round(score, 4)}
+        for ranked_hash, score in ranked if ranked_hash in songs_by_hash
+    ]
+
+@api_router.put("/songs/{song_id}/favorite")
+async def toggle_favorite(song_id: str):
+    """Toggle favorite status of a song"""
+    song = await db.songs.find_one({"id": song_id})
+    if not song:
+        raise HTTPException(status_code=404, detail="Song not found")
+    
+    new_favorite_status = not song.get("is_favorite", False)
+    async with library_version.change() as version:
+        await db.songs.update_one(
+            {"id": song_id},
+            {"$set": {"is_favorite": new_favorite_status, "version": version}}
+        )
+        song_catalog.upsert([{**song, "is_favorite": new_favorite_status, "version": version}])
+    event_hub.publish("favorite_changed", {"version": version, "id": song_id, "is_favorite": new_favorite_status})
+    stats_snapshot.favorite_changed(song_id, new_favorite_status)
+    
+    return {"is_favorite": new_favorite_status}
+
+@api_router.get("/stats")
+async def get_stats(request: Request, response: Response):
+    """Get library statistics"""
+    etag = library_version.etag(request)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return await stats_snapshot.get()
+
+@api_router.get("/analytics/top-tracks")
+async def get_top_tracks(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                         limit: int = Query(10, ge=1, le=100)):
+    """Most played songs between ``start`` and ``end`` (default: the last 7 days)"""
+    start, end = analytics_window(start, end)
+    totals = await rollup_totals(start, end, "song_id")
+    top = heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1]["plays"], item[0]))
+    songs = await db.songs.find({"id": {"$in": [song_id for song_id, _ in top]}}).to_list(len(top))
+    songs = {song["id"]: song for song in songs}
+    return {
+        "start": start,
+        "end": end,
+        "tracks": [
+            {"song": Song(**songs[song_id]), "plays": total["plays"],
+             "listening_seconds": round(total["listening_seconds"], 1)}
+            for song_id, total in top if song_id in songs
+        ]
+    }
+
+@api_router.get("/analytics/top-artists")
+async def get_top_artists(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                          limit: int = Query(10, ge=1, le=100)):
+    """Most played artists between ``start`` and ``end`` (default: the last 7 days)"""
+    start, end = analytics_window(start, end)
+    totals = await rollup_totals(start, end, "artist")
+    top = heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1]["plays"], item[0]))
+    return {
+        "start": start,
+        "end": end,
+        "artists": [
+            {"artist": artist, "plays": total["plays"], "listening_seconds": round(total["listening_seconds"], 1)}
+            for artist, total in top
+        ]
+    }
+
+@api_router.get("/analytics/listening-time")
+async def get_listening_time(days: int = Query(30, ge=1, le=MAX_ANALYTICS_DAYS)):
+    """Plays and listening time per UTC day for the last ``days`` days
+
+    Listening time assumes each counted play ran for the song's full duration.
+    """
+    first_day = day_start(datetime.utcnow()) - timedelta(days=days - 1)
+    per_day = {
+        row["_id"]: row
+        async for row in db.play_rollups_daily.aggregate([
+            {"$match": {"start": {"$gte": first_day}}},
+            {"$group": {
+                "_id": "$start",
+                "plays": {"$sum": "$plays"},
+                "listening_seconds": {"$sum": "$listening_seconds"}
+            }}
+        ])
+    }
+    return [
+        {
+            "date": day.date().isoformat(),
+            "plays": per_day.get(day, {}).get("plays", 0),
+            "listening_seconds": round(per_day.get(day, {}).get("listening_seconds", 0.0), 1)
+        }
+        for day in (first_day + timedelta(days=offset) for offset in range(days))
+    ]
+
+@api_router.post("/playlists", response_model=Playlist)
+async def create_playlist(playlist_data: PlaylistCreate):
+    """Create a new playlist"""
+    playlist = Playlist(**playlist_data.dict())
+    async with library_version.change() as version, playlist_version.change():
+        await db.playlists.insert_one(playlist.dict())
+    event_hub.publish("playlist_created", {"version": version, "playlist": playlist.dict()})
+    return playlist
+
+@api_router.get("/playlists", response_model=List[Playlist])
+async def get_playlists(request: Request, response: Response):
+    """Get all playlists"""
+    etag = playlist_version.etag(request)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    playlists = await db.playlists.find().to_list(1000)
+    return [Playlist(**playlist) for playlist in playlists]
+
+@api_router.put("/playlists/{playlist_id}/songs/{song_id}")
+async def add_song_to_playlist(playlist_id: str, song_id: str):
+    """Add a song to a playlist"""
+    song = await db.songs.find_one({"id": song_id}, {"_id": 1})
+    if not song:
+        raise HTTPException(status_code=404, detail="Song not found")
+    
+    async with library_version.change() as version, playlist_version.change():
+        result = await db.playlists.update_one(
+            {"id": playlist_id},
+            {
+                "$addToSet": {"song_ids": song_id},
+                "$set": {"updated_at": datetime.utcnow()}
+            }
+        )
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    event_hub.publish("playlist_updated", {"version": version, "id": playlist_id, "added": [song_id]})
+    
+    return {"message": "Song added to playlist"}
+
+@api_router.post("/playlists/{playlist_id}/songs")
+async def add_songs_to_playlist(playlist_id: str, update: PlaylistSongsUpdate):
+    """Add several songs to a playlist, appended or inserted at ``position``"""
+    song_ids = list(dict.fromkeys(update.song_ids))
+    existing = set(await db.songs.distinct("id", {"id": {"$in": song_ids}}))
+    valid = [song_id for song_id in song_ids if song_id in existing]
+    
+    if update.position is None:
+        change = {"$addToSet": {"song_ids": {"$each": valid}}, "$set": {"updated_at": datetime.utcnow()}}
+    else:
+        # Pipeline update: drop ids already present, then splice the rest in at position
+        new_ids = {"$filter": {
+            "input": valid,
+            "as": "song_id",
+            "cond": {"$eq": [{"$in": ["$$song_id", "$song_ids"]}, False]}
+        }}
+        position = max(update.position, 0)
+        change = [{"$set": {
+            "song_ids": {"$concatArrays": [
+                {"$slice": ["$song_ids", position]} if position else [],
+                new_ids,
+                {"$slice": ["$song_ids", position, 2 ** 31 - 1]}
+            ]},
+            "updated_at": datetime.utcnow()
+        }}]
+    async with library_version.change() as version, playlist_version.change():
+        result = await db.playlists.update_one({"id": playlist_id}, change)
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    event_hub.publish("playlist_updated", {
+        "version": version, "id": playlist_id, "added": valid, "position": update.position
+    })
+    
+    return {
+        "added": valid,
+        "missing": [song_id for song_id in song_ids if song_id not in existing]
+    }
+
+@api_router.delete("/playlists/{playlist_id}/songs")
+async def remove_songs_from_playlist(playlist_id: str, update: PlaylistSongsUpdate):
+    """Remove several songs from a playlist"""
+    async with library_version.change() as version, playlist_version.change():
+        result = await db.playlists.update_one(
+            {"id": playlist_id},
+            {
+                "$pull": {"song_ids": {"$in": update.song_ids}},
+                "$set": {"updated_at": datetime.utcnow()}
+            }
+        )
+    if not result.matched_count:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    event_hub.publish("playlist_updated", {"version": version, "id": playlist_id, "removed": update.song_ids})
+    return {"message": "Songs removed from playlist"}
+
+@api_router.put("/playlists/{playlist_id}/songs")
+async def reorder_playlist(playlist_id: str, update: PlaylistSongsUpdate):
+    """Reorder a playlist; ``song_ids`` must be a permutation of its current songs"""
+    song_ids = update.song_ids
+    if len(set(song_ids)) != len(song_ids):
+        raise HTTPException(status_code=400, detail="Song ids must be unique")
+    
+    # Only applies if the playlist still holds exactly these songs
+    async with library_version.change() as version, playlist_version.change():
+        result = await db.playlists.update_one(
+            {"id": playlist_id, "song_ids": {"$size": len(song_ids), "$all": song_ids}} if song_ids
+            else {"id": playlist_id, "song_ids": {"$size": 0}},
+            {"$set": {"song_ids": song_ids, "updated_at": datetime.utcnow()}}
+        )
+    if not result.matched_count:
+        if not await db.playlists.find_one({"id": playlist_id}, {"_id": 1}):
+            raise HTTPException(status_code=404, detail="Playlist not found")
+        raise HTTPException(status_code=409, detail="Song ids do not match the playlist's current songs")
+    event_hub.publish("playlist_updated", {"version": version, "id": playlist_id, "song_ids": song_ids})
+    return {"message": "Playlist reordered"}
+
+@api_router.get("/playlists/{playlist_id}/songs")
+async def get_playlist_songs(playlist_id: str, skip: int = Query(0, ge=0),
+                             limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    """Get a page of a playlist's songs, resolved in one aggregation"""
+    result = await db.playlists.aggregate([
+        {"$match": {"id": playlist_id}},
+        {"$project": {
+            "_id": 0,
+            "total": {"$size": "$song_ids"},
+            "song_ids": {"$slice": ["$song_ids", skip, limit]}
+        }},
+        {"$lookup": {"from": "songs", "localField": "song_ids", "foreignField": "id", "as": "songs"}},
+        {"$project": {"songs._id": 0}}
+    ]).to_list(1)
+    if not result:
+        raise HTTPException(status_code=404, detail="Playlist not found")
+    
+    # $lookup does not preserve array order
+    page = result[0]
+    songs_by_id = {song["id"]: song for song in page["songs"]}
+    songs = [songs_by_id[song_id] for song_id in page["song_ids"] if song_id in songs_by_id]
+    return Response(
+        content='{"total": %d, "skip": %d, "limit": %d, "songs": [%s]}' % (
+            page["total"], skip, limit, ",".join(encode_song(song) for song in songs)
+        ),
+        media_type="application/json"
+    )
+
+@api_router.get("/settings", response_model=UserSettings)
+async def get_settings():
+    """Get user settings"""
+    settings = await db.settings.find_one() or {}
+    return UserSettings(**settings)
+
+@api_router.put("/settings")
+async def update_settings(settings: UserSettings):
+    """Update user settings"""
+    await db.settings.replace_one(
+        {},
+        settings.dict(),
+        upsert=True
+    )
+    return settings
+
+@api_router.get("/events")
+async def stream_events(last_event_id: Optional[str] = Header(None)):
+    """Server-Sent Events stream of library changes
+
+    Event types: songs_added, songs_updated, songs_removed, favorite_changed,
+    play_counts, playlist_created, playlist_updated and stats. A ``resync``
+    event means events were missed and the client should refetch.
+    """
+    try:
+        last_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_id = None
+    queue = event_hub.subscribe(last_id)
+    
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    yield f"id: {event_hub.sequence}\nevent: resync\ndata: {{}}\n\n"
+                    return
+                yield message
+        finally:
+            event_hub.unsubscribe(queue)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@api_router.get("/metrics")
+async def get_metrics():
+    """Expose collected metrics in Prometheus text format"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Include the router in the main app
+app.include_router(api_router)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_credentials=True,
+    allow_origins=["*"],
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["ETag", "Link", "Location", "Upload-Offset", "X-Next-Cursor", "X-Seek-Time", "X-Seek-Offset"],
+)
+
+app.add_middleware(MetricsMiddleware)
+
+# Configure logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+@app.on_event("startup")
+async def create_indexes():
+    await db.blobs.create_index("hash", unique=True)
+    await db.songs.create_index("id", unique=True)
+    for field in SONG_SORT_FIELDS:
+        await db.songs.create_index([(field, 1), ("id", 1)])
+    await db.songs.create_index("content_hash")
+    await db.features.create_index("hash", unique=True)
+    await db.loudness.create_index("hash", unique=True)
+    await db.songs.create_index([("artist", 1), ("album", 1)])
+    await db.songs.create_index([("source", 1), ("file_path", 1)])
+    await db.songs.create_index("version")
+    await db.song_deletions.create_index("version")
+    await db.playlists.create_index("id", unique=True)
+    await db.upload_sessions.create_index("id", unique=True)
+    await db.upload_sessions.create_index("expires_at")
+    await db.play_events.create_index("played_at")
+    await db.play_events.create_index([("song_id", 1), ("played_at", 1)])
+    await db.play_rollups_hourly.create_index([("start", 1), ("song_id", 1)], unique=True)
+    await db.play_rollups_daily.create_index([("start", 1), ("song_id", 1)], unique=True)
+
+@app.on_event("startup")
+async def load_library_version():
+    await library_version.load()
+    await playlist_version.load()
+
+@app.on_event("startup")
+async def build_search_index():
+    async for song in db.songs.find({}, {"_id": 0, "id": 1, "title": 1, "artist": 1, "album": 1}):
+        search_index.add(song)
+    logger.info(f"Search index built with {len(search_index.documents)} songs")
+
+@app.on_event("startup")
+async def load_song_catalog():
+    await song_catalog.load()
+    logger.info(f"Song catalog loaded with {len(song_catalog.rows)} songs")
+
+@app.on_event("startup")
+async def load_feature_index():
+    async for features in db.features.find({}, {"_id": 0, "hash": 1, "vector": 1}):
+        feature_index.add(features["hash"], features["vector"])
+    logger.info(f"Feature index loaded with {feature_index.size} tracks")
+
+@app.on_event("startup")
+async def start_metadata_executor():
+    global metadata_executor
+    metadata_executor = ProcessPoolExecutor(max_workers=METADATA_WORKERS)
+
+def lower_priority():
+    """Process pool initializer that yields the CPU to ingest and request handling"""
+    if hasattr(os, "nice"):
+        os.nice(ANALYSIS_NICENESS)
+
+@app.on_event("startup")
+async def start_analysis_executor():
+    global analysis_executor
+    analysis_executor = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS, initializer=lower_priority)
+
+@app.on_event("startup")
+async def start_play_flush():
+    global play_flush_task
+    play_flush_task = asyncio.create_task(play_buffer.run(PLAY_FLUSH_INTERVAL))
+
+@app.on_event("startup")
+async def start_upload_expiry():
+    global upload_expiry_task
+    upload_expiry_task = asyncio.create_task(expire_upload_sessions())
+
+@app.on_event("shutdown")
+async def stop_upload_expiry():
+    if upload_expiry_task:
+        upload_expiry_task.cancel()
+
+@app.on_event("shutdown")
+async def flush_play_counts():
+    if play_flush_task:
+        play_flush_task.cancel()
+    await play_buffer.flush()
+
+@app.on_event("shutdown")
+async def shutdown_metadata_executor():
+    if metadata_executor:
+        metadata_executor.shutdown(wait=True, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def shutdown_analysis_executor():
+    if analysis_executor:
+        analysis_executor.shutdown(wait=True, cancel_futures=True)
+
+@app.on_event("shutdown")
+async def shutdown_prefetcher():
+    prefetcher.shutdown()
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
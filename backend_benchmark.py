@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+Offline Backend Benchmark for Music Player Application
+Runs the FastAPI app in-process against a local MongoDB (or an in-memory
+stand-in), seeds a synthetic library and measures throughput and latency
+for streaming, ranged seeks, uploads, listings, search and stats.
+
+Results are written as JSON so runs from different commits can be compared:
+
+    python backend_benchmark.py --output before.json
+    python backend_benchmark.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+
+def make_wav(seconds, sample_rate=22050, seed=0):
+    """Build a mono 16-bit PCM WAV of the given length with deterministic noise"""
+    rng = random.Random(seed)
+    frames = int(seconds * sample_rate)
+    # A short random period repeated keeps generation fast but files distinct
+    period = bytes(rng.getrandbits(8) for _ in range(4096))
+    data = (period * (frames * 2 // len(period) + 1))[:frames * 2]
+    header = b"RIFF" + struct.pack("<I", 36 + len(data)) + b"WAVE"
+    header += b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16)
+    header += b"data" + struct.pack("<I", len(data))
+    return header + data
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, errors, transferred=0):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "requests": count,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 4),
+        "throughput_rps": round(count / elapsed, 2) if elapsed else None,
+        "mb_per_s": round(transferred / elapsed / 1e6, 2) if elapsed and transferred else None,
+        "latency_ms": {
+            "mean": round(sum(latencies) / count * 1000, 3) if count else None,
+            "p50": round(percentile(latencies, 0.50) * 1000, 3) if count else None,
+            "p99": round(percentile(latencies, 0.99) * 1000, 3) if count else None,
+            "max": round(latencies[-1] * 1000, 3) if count else None,
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BackendBenchmark:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.results = {}
+        self.song_ids = []
+        self.file_sizes = {}
+        self.workdir = None
+        self.server = None
+
+    def load_server(self):
+        """Import the app with storage redirected to a scratch directory"""
+        os.environ.setdefault("MONGO_URL", self.args.mongo_url)
+        os.environ["DB_NAME"] = self.args.db_name
+        sys.path.insert(0, str(BACKEND_DIR))
+        import server
+
+        # Per-request access logs would dominate the timings
+        logging.getLogger().setLevel(logging.WARNING)
+
+        if self.args.mongo == "memory":
+            try:
+                import mongomock_motor
+            except ImportError:
+                sys.exit("--mongo memory requires the mongomock-motor package")
+            server.client = mongomock_motor.AsyncMongoMockClient()
+            server.db = server.client[self.args.db_name]
+
+        self.workdir = Path(tempfile.mkdtemp(prefix="music-bench-"))
+        for name in ("UPLOAD_DIR", "ARTWORK_DIR", "INDEX_DIR"):
+            path = self.workdir / name.lower()
+            path.mkdir()
+            setattr(server, name, path)
+        self.server = server
+
+    async def run_concurrent(self, name, total, make_request, concurrency=None):
+        """Issue `total` requests with bounded concurrency and record latencies"""
+        concurrency = concurrency or self.args.concurrency
+        latencies = []
+        errors = 0
+        transferred = 0
+        counter = iter(range(total))
+
+        async def worker():
+            nonlocal errors, transferred
+            for i in counter:
+                start = time.perf_counter()
+                try:
+                    response = await make_request(i)
+                    ok = response.status_code < 400
+                    transferred += len(response.content)
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append(time.perf_counter() - start)
+                if not ok:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        self.results[name] = summarize(latencies, elapsed, errors, transferred)
+        self.results[name]["concurrency"] = concurrency
+        self.report(name)
+
+    def report(self, name):
+        result = self.results[name]
+        latency = result["latency_ms"]
+        extra = f", {result['mb_per_s']} MB/s" if result["mb_per_s"] else ""
+        print(
+            f"📊 {name:<16} {result['requests']:>6} req  {result['throughput_rps']:>9} req/s  "
+            f"p50 {latency['p50']} ms  p99 {latency['p99']} ms  errors {result['errors']}{extra}"
+        )
+
+    async def bench_uploads(self, client):
+        """Upload distinct synthetic tracks; these also back the seeded library"""
+        files = [
+            make_wav(self.args.track_seconds, seed=self.args.seed * 100003 + i)
+            for i in range(self.args.tracks)
+        ]
+
+        async def upload(i):
+            response = await client.post(
+                "/api/songs/upload", files={"file": (f"bench-{i}.wav", files[i], "audio/wav")}
+            )
+            if response.status_code == 200:
+                song = response.json()
+                self.song_ids.append(song["id"])
+                self.file_sizes[song["id"]] = song["file_size"]
+            return response
+
+        await self.run_concurrent("upload", len(files), upload)
+
+    async def settle(self):
+        """Wait for background analysis started by uploads so it does not skew timings"""
+        while self.server.background_tasks:
+            await asyncio.gather(*list(self.server.background_tasks), return_exceptions=True)
+
+    async def seed_library(self):
+        """Bulk-insert catalogue entries that reuse the uploaded audio files"""
+        # Every song gets a play history; mongomock cannot apply $max to a null last_played
+        async with self.server.library_version.change() as version:
+            await self.server.db.songs.update_many(
+                {"id": {"$in": self.song_ids}},
+                {"$set": {"last_played": datetime.utcnow() - timedelta(days=1), "version": version}}
+            )
+            await self.server.song_catalog.reload({"id": {"$in": self.song_ids}})
+        extra = self.args.library_size - len(self.song_ids)
+        if extra <= 0 or not self.song_ids:
+            return
+        templates = await self.server.db.songs.find(
+            {"id": {"$in": self.song_ids}}, {"_id": 0}
+        ).to_list(len(self.song_ids))
+        docs = []
+        for i in range(extra):
+            doc = dict(templates[i % len(templates)])
+            doc.update(
+                id=str(uuid.uuid4()),
+                title=f"Synthetic Track {i}",
+                artist=f"Artist {i % 500}",
+                album=f"Album {i % 2000}",
+                play_count=self.rng.randint(0, 1000),
+                is_favorite=self.rng.random() < 0.1,
+                date_added=datetime.utcnow(),
+                last_played=datetime.utcnow() - timedelta(seconds=self.rng.randrange(30 * 86400)),
+            )
+            docs.append(doc)
+        async with self.server.library_version.change() as version:
+            for doc in docs:
+                doc["version"] = version
+            for start in range(0, len(docs), 5000):
+                await self.server.db.songs.insert_many(docs[start:start + 5000])
+            await self.server.on_songs_added(docs, analyze=False)
+        print(f"🌱 Seeded library with {self.args.library_size} songs")
+
+    async def bench_streams(self, client):
+        async def stream(i):
+            return await client.get(f"/api/songs/{self.song_ids[i % len(self.song_ids)]}/stream")
+
+        await self.run_concurrent("stream_full", self.args.requests, stream)
+
+    async def bench_seeks(self, client):
+        async def seek(i):
+            song_id = self.rng.choice(self.song_ids)
+            size = self.file_sizes[song_id]
+            start = self.rng.randrange(0, max(1, size - self.args.seek_bytes))
+            end = min(size, start + self.args.seek_bytes) - 1
+            return await client.get(
+                f"/api/songs/{song_id}/stream", headers={"Range": f"bytes={start}-{end}"}
+            )
+
+        await self.run_concurrent("stream_seek", self.args.requests, seek)
+
+    async def bench_listings(self, client):
+        async def listing(i):
+            return await client.get("/api/songs", params={"limit": self.args.page_size})
+
+        await self.run_concurrent("list_page", self.args.requests, listing)
+
+        async def favorites(i):
+            return await client.get("/api/songs", params={
+                "favorite": "true", "sort": "play_count", "order": "desc", "limit": self.args.page_size
+            })
+
+        await self.run_concurrent("list_favorites", self.args.requests, favorites)
+
+        async def full_listing(i):
+            return await client.get("/api/songs")
+
+        await self.run_concurrent("list_full", max(1, self.args.requests // 20), full_listing)
+
+    async def bench_search(self, client):
+        terms = ["synthetic", "track 12", "artist 4", "album 1", "bench"]
+
+        async def search(i):
+            return await client.get("/api/search", params={"q": terms[i % len(terms)]})
+
+        await self.run_concurrent("search", self.args.requests, search)
+
+    async def bench_stats(self, client):
+        async def stats(i):
+            return await client.get("/api/stats")
+
+        await self.run_concurrent("stats", self.args.requests, stats)
+
+    async def check_play_flush(self):
+        """Fail the run if plays recorded by the stream benchmarks could not be written"""
+        play_buffer = self.server.play_buffer
+        await play_buffer.flush()
+        if play_buffer.pending or play_buffer.events:
+            sys.exit(f"❌ {len(play_buffer.pending)} play counts and {len(play_buffer.events)} play events "
+                     "failed to flush; stream timings include a failing write path")
+
+    async def run(self):
+        self.load_server()
+        app = self.server.app
+        await app.router.startup()
+        try:
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=60) as client:
+                await self.bench_uploads(client)
+                if not self.song_ids:
+                    sys.exit("❌ No uploads succeeded; cannot continue")
+                await self.settle()
+                await self.seed_library()
+                for name in self.args.only or BENCHMARKS:
+                    await getattr(self, f"bench_{name}")(client)
+                await self.check_play_flush()
+        finally:
+            await app.router.shutdown()
+            if self.args.mongo == "local":
+                await self.server.client.drop_database(self.args.db_name)
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        return {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": {
+                key: value for key, value in vars(self.args).items()
+                if key not in ("output", "compare")
+            },
+            "results": self.results,
+        }
+
+
+BENCHMARKS = ["streams", "seeks", "listings", "search", "stats"]
+
+
+def compare(current, baseline_path, threshold):
+    """Print per-benchmark deltas against a previous run; return True on regression"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\n🔍 Comparing against {baseline_path} (commit {baseline.get('commit')})")
+    regressed = False
+    for name, result in current["results"].items():
+        before = baseline.get("results", {}).get(name)
+        if not before:
+            continue
+        for metric in ("p50", "p99"):
+            old, new = before["latency_ms"][metric], result["latency_ms"][metric]
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            flag = "❌" if change > threshold else "✅"
+            regressed |= change > threshold
+            print(f"{flag} {name:<16} {metric} {old:>9.3f} -> {new:>9.3f} ms ({change:+.1%})")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo", choices=["memory", "local"], default="memory",
+                        help="in-memory mongomock-motor stand-in or a local MongoDB")
+    parser.add_argument("--mongo-url", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="music_benchmark")
+    parser.add_argument("--tracks", type=int, default=20, help="distinct audio files to upload")
+    parser.add_argument("--track-seconds", type=float, default=30.0)
+    parser.add_argument("--library-size", type=int, default=2000, help="total songs in the catalogue")
+    parser.add_argument("--requests", type=int, default=500, help="requests per benchmark")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seek-bytes", type=int, default=64 * 1024)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--compare", help="previous JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="relative latency increase counted as a regression")
+    args = parser.parse_args()
+
+    print(f"🚀 Benchmarking backend ({args.mongo} MongoDB, {args.library_size} songs)")
+    results = asyncio.run(BackendBenchmark(args).run())
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+        print(f"💾 Results written to {args.output}")
+    else:
+        print(output)
+
+    if args.compare:
+        return 1 if compare(results, args.compare, args.threshold) else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
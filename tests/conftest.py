@@ -0,0 +1,70 @@
+import os
+import struct
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# The Motor client connects lazily, so importing the app needs no running MongoDB
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "music_player_test")
+
+
+@pytest.fixture
+def memory_db(monkeypatch):
+    """Point the app at an in-memory mongomock database"""
+    mongomock_motor = pytest.importorskip("mongomock_motor")
+    import server
+
+    client = mongomock_motor.AsyncMongoMockClient()
+    monkeypatch.setattr(server, "client", client)
+    monkeypatch.setattr(server, "db", client["music_player_test"])
+    # Start each test from empty in-memory state as well
+    monkeypatch.setattr(server, "library_version", server.LibraryVersion())
+    monkeypatch.setattr(server, "playlist_version", server.LibraryVersion("playlist_version"))
+    monkeypatch.setattr(server, "song_catalog", server.SongCatalog())
+    monkeypatch.setattr(server, "search_index", server.SearchIndex())
+    monkeypatch.setattr(server, "feature_index", server.FeatureIndex(server.FEATURE_DIMENSIONS))
+    monkeypatch.setattr(server, "event_hub", server.EventHub(server.EVENT_QUEUE_SIZE, server.EVENT_HISTORY_SIZE))
+    monkeypatch.setattr(server, "stats_snapshot", server.StatsSnapshot(server.STATS_REFRESH_INTERVAL))
+    monkeypatch.setattr(server, "play_buffer", server.PlayCountBuffer(server.PLAY_DEDUP_WINDOW))
+    monkeypatch.setattr(server, "analysis_unavailable", set())
+    return server.db
+
+
+def wav_bytes(seconds=1.0, amplitude=8000, frequency=440.0, rate=22050):
+    """A mono 16-bit PCM WAV file holding a sine tone"""
+    samples = np.arange(int(seconds * rate))
+    pcm = (np.sin(samples * 2 * np.pi * frequency / rate) * amplitude).astype("<i2").tobytes()
+    return (b"RIFF" + struct.pack("<I", 36 + len(pcm)) + b"WAVEfmt "
+            + struct.pack("<IHHIIHH", 16, 1, 1, rate, rate * 2, 2, 16)
+            + b"data" + struct.pack("<I", len(pcm)) + pcm)
+
+
+@pytest.fixture
+def api(memory_db):
+    """Factory for an HTTP client that calls the app in-process, without startup events"""
+    import httpx
+    import server
+
+    return lambda: httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://test")
+
+
+@pytest.fixture
+def make_wav():
+    return wav_bytes
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    """Keep uploads, artwork and indexes in a temporary directory"""
+    import server
+
+    for name in ("UPLOAD_DIR", "ARTWORK_DIR", "INDEX_DIR"):
+        directory = tmp_path / name.lower()
+        directory.mkdir()
+        monkeypatch.setattr(server, name, directory)
+    return tmp_path
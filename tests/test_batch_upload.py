@@ -0,0 +1,71 @@
+import asyncio
+import hashlib
+
+from pymongo.errors import BulkWriteError
+
+import server
+
+
+def batch(*files):
+    return [("files", file) for file in files]
+
+
+def test_batch_upload_reports_each_file(api, storage, make_wav):
+    async def scenario():
+        tone, other = make_wav(), make_wav(frequency=880)
+        async with api() as client:
+            response = await client.post("/api/songs/upload/batch", files=batch(
+                ("a.wav", tone, "audio/wav"),
+                ("notes.txt", b"hello", "text/plain"),
+                ("b.wav", other, "audio/wav"),
+                ("a-again.wav", tone, "audio/wav"),
+            ))
+        body = response.json()
+        assert (body["uploaded"], body["failed"]) == (3, 1)
+        assert [result["status_code"] for result in body["results"]] == [200, 400, 200, 200]
+
+        songs = await server.db.songs.find({}, {"_id": 0}).to_list(None)
+        assert sorted(song["title"] for song in songs) == ["a", "a-again", "b"]
+        # One bulk insert, so every song shares one library version
+        assert len({song["version"] for song in songs}) == 1
+        blob = await server.db.blobs.find_one({"hash": hashlib.sha256(tone).hexdigest()})
+        assert blob["ref_count"] == 2
+        assert sorted(record.id for record in server.song_catalog.query("title", False)) == sorted(
+            song["id"] for song in songs)
+
+    asyncio.run(scenario())
+
+
+def test_failed_inserts_release_their_blobs(api, storage, make_wav, monkeypatch):
+    insert_many = type(server.db.songs).insert_many
+
+    async def insert_all_but_second(self, documents, *args, **kwargs):
+        await insert_many(self, documents[:1] + documents[2:], *args, **kwargs)
+        raise BulkWriteError({"writeErrors": [{"index": 1, "errmsg": "duplicate key"}]})
+
+    monkeypatch.setattr(type(server.db.songs), "insert_many", insert_all_but_second)
+
+    async def scenario():
+        files = [make_wav(frequency=frequency) for frequency in (220, 440, 880)]
+        async with api() as client:
+            response = await client.post("/api/songs/upload/batch", files=batch(
+                *((f"{i}.wav", data, "audio/wav") for i, data in enumerate(files))
+            ))
+        body = response.json()
+        assert (body["uploaded"], body["failed"]) == (2, 1)
+        failed = body["results"][1]
+        assert failed["status_code"] == 500 and "duplicate key" in failed["error"]
+
+        # The failed file's only reference is gone, and so is its blob
+        hashes = [hashlib.sha256(data).hexdigest() for data in files]
+        assert await server.db.blobs.find_one({"hash": hashes[1]}) is None
+        assert not list((storage / "upload_dir").glob(f"{hashes[1]}*"))
+        blobs = await server.db.blobs.find({"hash": {"$in": hashes}}).to_list(None)
+        assert [blob["ref_count"] for blob in blobs] == [1, 1]
+        # Only the inserted songs reach the catalog and the search index
+        assert sorted(record.id for record in server.song_catalog.query("title", False)) == sorted(
+            result["song"]["id"] for result in body["results"] if "song" in result)
+        assert sorted(server.search_index.documents) == sorted(
+            result["song"]["id"] for result in body["results"] if "song" in result)
+
+    asyncio.run(scenario())
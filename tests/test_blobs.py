@@ -0,0 +1,83 @@
+import asyncio
+import hashlib
+
+import pytest
+
+import server
+
+
+def stored_files(storage):
+    return sorted(path.name for path in (storage / "upload_dir").iterdir())
+
+
+async def upload(client, data, filename="song.wav"):
+    return await client.post("/api/songs/upload", files={"file": (filename, data, "audio/wav")})
+
+
+def test_identical_uploads_share_one_blob(api, storage, make_wav):
+    async def scenario():
+        data = make_wav()
+        content_hash = hashlib.sha256(data).hexdigest()
+        async with api() as client:
+            first = (await upload(client, data, "first.wav")).json()
+            second = (await upload(client, data, "second.wav")).json()
+            other = (await upload(client, make_wav(frequency=880))).json()
+
+        assert first["id"] != second["id"]
+        assert first["file_path"] == second["file_path"] != other["file_path"]
+        assert first["content_hash"] == second["content_hash"] == content_hash
+        assert stored_files(storage) == sorted([f"{content_hash}.wav", f"{other['content_hash']}.wav"])
+        blob = await server.db.blobs.find_one({"hash": content_hash})
+        assert blob["ref_count"] == 2
+
+        await server.release_blob(content_hash)
+        assert (await server.db.blobs.find_one({"hash": content_hash}))["ref_count"] == 1
+        assert f"{content_hash}.wav" in stored_files(storage)
+        await server.release_blob(content_hash)
+        assert await server.db.blobs.find_one({"hash": content_hash}) is None
+        assert stored_files(storage) == [f"{other['content_hash']}.wav"]
+
+    asyncio.run(scenario())
+
+
+def test_failed_song_insert_releases_its_reference(api, storage, make_wav, monkeypatch):
+    async def scenario():
+        data = make_wav()
+        async with api() as client:
+            await upload(client, data)
+
+            async def fail(self, document, *args, **kwargs):
+                raise RuntimeError("write failed")
+
+            monkeypatch.setattr(type(server.db.songs), "insert_one", fail)
+            response = await upload(client, data)
+        assert response.status_code == 500
+        blob = await server.db.blobs.find_one({"hash": hashlib.sha256(data).hexdigest()})
+        assert blob["ref_count"] == 1
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("registered_meanwhile", [False, True])
+def test_failed_extraction_leaves_no_orphan_blob(api, storage, make_wav, monkeypatch, registered_meanwhile):
+    async def scenario():
+        data = make_wav()
+        content_hash = hashlib.sha256(data).hexdigest()
+
+        async def broken_pool(file_path, content_hash=None):
+            if registered_meanwhile:
+                # A concurrent upload of the same content finished first
+                await server.db.blobs.insert_one({"hash": content_hash, "ref_count": 1, "file_path": file_path})
+            raise RuntimeError("process pool is broken")
+
+        monkeypatch.setattr(server, "extract_metadata_async", broken_pool)
+        async with api() as client:
+            response = await upload(client, data)
+        assert response.status_code == 500
+        if registered_meanwhile:
+            assert stored_files(storage) == [f"{content_hash}.wav"]
+        else:
+            assert stored_files(storage) == []
+            assert await server.db.blobs.count_documents({}) == 0
+
+    asyncio.run(scenario())
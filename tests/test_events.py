@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    hub = server.EventHub(queue_size=3, history_size=5)
+    monkeypatch.setattr(server, "event_hub", hub)
+    return hub
+
+
+def parse(message):
+    fields = dict(line.split(": ", 1) for line in message.strip().split("\n"))
+    return int(fields["id"]), fields["event"], fields["data"]
+
+
+async def open_stream(last_event_id=None):
+    response = await server.stream_events(last_event_id)
+    stream = response.body_iterator
+    assert await stream.__anext__() == "retry: 3000\n\n"
+    return stream
+
+
+async def read(stream, count):
+    return [parse(await asyncio.wait_for(stream.__anext__(), 1)) for _ in range(count)]
+
+
+def publish(hub, count):
+    for _ in range(count):
+        hub.publish("play_counts", {"increments": {"song": 1}})
+
+
+def test_subscribers_receive_events_in_order(hub):
+    async def scenario():
+        stream = await open_stream()
+        hub.publish("favorite_changed", {"id": "song", "is_favorite": True})
+        hub.publish("songs_removed", {"ids": ["other"]})
+        assert await read(stream, 2) == [
+            (1, "favorite_changed", '{"id":"song","is_favorite":true}'),
+            (2, "songs_removed", '{"ids":["other"]}'),
+        ]
+        await stream.aclose()
+        assert not hub.subscribers
+
+    asyncio.run(scenario())
+
+
+def test_reconnect_replays_missed_events(hub):
+    async def scenario():
+        publish(hub, 4)
+        stream = await open_stream("2")
+        assert [event[0] for event in await read(stream, 2)] == [3, 4]
+        publish(hub, 1)
+        assert [event[0] for event in await read(stream, 1)] == [5]
+        await stream.aclose()
+
+        # Nothing was missed, and an unreadable id counts as a fresh connection
+        for last_event_id in ("5", "garbage"):
+            stream = await open_stream(last_event_id)
+            publish(hub, 1)
+            assert [event[1] for event in await read(stream, 1)] == ["play_counts"]
+            await stream.aclose()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("queue_size, history_size", [(10, 3), (3, 10)])
+def test_gaps_that_cannot_be_replayed_ask_for_a_resync(monkeypatch, queue_size, history_size):
+    monkeypatch.setattr(server, "event_hub", server.EventHub(queue_size, history_size))
+
+    async def scenario():
+        # The missed events have either left the history or would overflow the queue
+        publish(server.event_hub, 6)
+        stream = await open_stream("1")
+        assert await read(stream, 1) == [(6, "resync", "{}")]
+        with pytest.raises(StopAsyncIteration):
+            await stream.__anext__()
+
+    asyncio.run(scenario())
+
+
+def test_slow_subscribers_are_dropped_with_a_resync(hub):
+    async def scenario():
+        stream = await open_stream()
+        publish(hub, 4)
+        assert not hub.subscribers
+        assert await read(stream, 1) == [(4, "resync", "{}")]
+        with pytest.raises(StopAsyncIteration):
+            await stream.__anext__()
+
+        # The client reconnects from the resync id and is live again
+        stream = await open_stream("4")
+        publish(hub, 1)
+        assert [event[0] for event in await read(stream, 1)] == [5]
+        await stream.aclose()
+
+    asyncio.run(scenario())
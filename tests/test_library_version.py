@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from server import LibraryVersion
+
+
+def test_version_is_published_only_after_the_change(memory_db):
+    async def scenario():
+        version = LibraryVersion()
+        await version.load()
+        async with version.change() as reserved:
+            assert reserved == 1
+            assert version.value == 0
+        assert version.value == 1
+        assert (await memory_db.counters.find_one({"_id": "library_version"}))["value"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_version_waits_for_earlier_changes_still_in_flight(memory_db):
+    async def scenario():
+        version = LibraryVersion()
+        first_reserved = asyncio.Event()
+        release_first = asyncio.Event()
+
+        async def slow_change():
+            async with version.change() as reserved:
+                first_reserved.set()
+                await release_first.wait()
+                return reserved
+
+        slow = asyncio.create_task(slow_change())
+        await first_reserved.wait()
+        async with version.change() as reserved:
+            assert reserved == 2
+        # Publishing 2 now would let ?since=2 skip the write of version 1
+        assert version.value == 0
+
+        release_first.set()
+        assert await slow == 1
+        assert version.value == 2
+
+    asyncio.run(scenario())
+
+
+def test_failed_change_still_releases_its_version(memory_db):
+    async def scenario():
+        version = LibraryVersion()
+        with pytest.raises(RuntimeError):
+            async with version.change():
+                raise RuntimeError("write failed")
+        assert version.value == 1 and not version.pending
+        async with version.change() as reserved:
+            assert reserved == 2
+        assert version.value == 2
+
+    asyncio.run(scenario())
+
+
+def test_load_resumes_from_the_stored_counter(memory_db):
+    async def scenario():
+        await memory_db.counters.insert_one({"_id": "library_version", "value": 41})
+        version = LibraryVersion()
+        await version.load()
+        assert version.value == 41
+        async with version.change() as reserved:
+            assert reserved == 42
+        assert version.value == 42
+
+    asyncio.run(scenario())
@@ -0,0 +1,155 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+
+from server import SONG_SORT_FIELDS, SongCatalog, cursor_filter, decode_cursor, encode_cursor
+
+
+def make_songs(count=60, seed=7):
+    rng = random.Random(seed)
+    songs = []
+    for i in range(count):
+        songs.append({
+            "id": f"song-{rng.randrange(10 ** 6):06d}-{i}",
+            "title": rng.choice(["Alpha", "beta", "Gamma", "Ünder", ""]),
+            "artist": rng.choice(["Artist A", "Artist B"]),
+            "album": rng.choice(["One", "Two", "Three"]),
+            "duration": float(rng.choice([120, 180.5, 240])),
+            "play_count": rng.randrange(4),
+            "is_favorite": rng.random() < 0.3,
+            "file_path": "/music/x.mp3",
+            "date_added": datetime(2024, 1, 1) + timedelta(minutes=rng.randrange(5)),
+            "last_played": rng.choice([None, datetime(2024, 2, 1, 12, 0, 0, 123000)]),
+        })
+    return songs
+
+
+def test_cursor_round_trip():
+    when = datetime(2024, 3, 1, 8, 30, 0, 250000)
+    cursor = encode_cursor({"date_added": when, "id": "abc"}, "date_added")
+    assert decode_cursor(cursor) == (when, "abc")
+    assert decode_cursor(encode_cursor({"id": "abc"}, "last_played")) == (None, "abc")
+
+
+@pytest.mark.parametrize("cursor", ["not base64!", "bm90IGpzb24=", ""])
+def test_invalid_cursor_is_a_400(cursor):
+    with pytest.raises(HTTPException) as excinfo:
+        decode_cursor(cursor)
+    assert excinfo.value.status_code == 400
+
+
+def test_cursor_filter_shapes():
+    cursor = encode_cursor({"title": "M", "id": "x"}, "title")
+    assert cursor_filter(cursor, "title", False) == {
+        "$or": [{"title": {"$gt": "M"}}, {"title": "M", "id": {"$gt": "x"}}]
+    }
+    # Nulls sort first: they follow everything when descending...
+    assert cursor_filter(cursor, "title", True) == {
+        "$or": [{"title": {"$lt": "M"}}, {"title": "M", "id": {"$lt": "x"}}, {"title": None}]
+    }
+    # ...and a null cursor is followed by every non-null value when ascending
+    null_cursor = encode_cursor({"id": "x"}, "last_played")
+    assert cursor_filter(null_cursor, "last_played", False) == {
+        "$or": [{"last_played": None, "id": {"$gt": "x"}}, {"last_played": {"$ne": None}}]
+    }
+    assert cursor_filter(null_cursor, "last_played", True) == {
+        "$or": [{"last_played": None, "id": {"$lt": "x"}}]
+    }
+
+
+async def database_pages(db, sort, descending, page_size):
+    """Page through the songs collection with keyset cursors"""
+    direction = -1 if descending else 1
+    pages, cursor = [], None
+    while True:
+        query = cursor_filter(cursor, sort, descending) if cursor else {}
+        songs = db.songs.find(query, {"_id": 0}).sort([(sort, direction), ("id", direction)])
+        page = await songs.limit(page_size).to_list(page_size)
+        if not page:
+            return pages
+        pages.append([song["id"] for song in page])
+        cursor = encode_cursor(page[-1], sort)
+
+
+@pytest.mark.parametrize("sort", SONG_SORT_FIELDS)
+@pytest.mark.parametrize("descending", [False, True])
+def test_database_pages_visit_every_song_once(memory_db, sort, descending):
+    songs = make_songs()
+    asyncio.run(memory_db.songs.insert_many([dict(song) for song in songs]))
+
+    database = asyncio.run(database_pages(memory_db, sort, descending, 7))
+    expected = asyncio.run(memory_db.songs.find({}, {"_id": 0})
+                           .sort([(sort, -1 if descending else 1), ("id", -1 if descending else 1)])
+                           .to_list(None))
+    assert [song_id for page in database for song_id in page] == [song["id"] for song in expected]
+
+
+def catalog_pages(catalog, sort, descending, page_size):
+    pages, after = [], None
+    while True:
+        records = catalog.query(sort, descending, after=after, limit=page_size)
+        page = records[:page_size]
+        if not page:
+            return pages
+        pages.append([record.id for record in page])
+        after = decode_cursor(catalog.cursor(page[-1], sort))
+
+
+@pytest.mark.parametrize("sort", SONG_SORT_FIELDS)
+@pytest.mark.parametrize("descending", [False, True])
+def test_catalog_and_database_pages_agree(memory_db, sort, descending):
+    songs = make_songs()
+    asyncio.run(memory_db.songs.insert_many([dict(song) for song in songs]))
+    catalog = SongCatalog()
+    catalog.upsert(songs)
+
+    database = asyncio.run(database_pages(memory_db, sort, descending, 7))
+    assert catalog_pages(catalog, sort, descending, 7) == database
+    assert sorted(song_id for page in database for song_id in page) == sorted(song["id"] for song in songs)
+
+
+def test_catalog_cursor_works_against_the_database(memory_db):
+    songs = make_songs()
+    asyncio.run(memory_db.songs.insert_many([dict(song) for song in songs]))
+    catalog = SongCatalog()
+    catalog.upsert(songs)
+
+    first = catalog.query("last_played", False, limit=10)[:10]
+    cursor = catalog.cursor(first[-1], "last_played")
+    rest = asyncio.run(memory_db.songs.find(cursor_filter(cursor, "last_played", False), {"_id": 0})
+               .sort([("last_played", 1), ("id", 1)]).to_list(None))
+    expected = [record.id for record in catalog.query("last_played", False)]
+    assert [record.id for record in first] + [song["id"] for song in rest] == expected
+
+
+def test_catalog_orders_follow_updates_and_removals():
+    songs = make_songs(200)
+    catalog = SongCatalog()
+    catalog.upsert(songs)
+    for sort in SONG_SORT_FIELDS:
+        catalog.order(sort)
+
+    rng = random.Random(3)
+    by_id = {song["id"]: song for song in songs}
+    for _ in range(30):
+        changed = [dict(by_id[song_id], play_count=rng.randrange(10), is_favorite=rng.random() < 0.5)
+                   for song_id in rng.sample(sorted(by_id), 5)]
+        by_id.update((song["id"], song) for song in changed)
+        catalog.upsert(changed)
+        removed = rng.sample(sorted(by_id), 2)
+        for song_id in removed:
+            del by_id[song_id]
+        catalog.remove(removed)
+        added = make_songs(3, seed=rng.randrange(10 ** 6))
+        by_id.update((song["id"], song) for song in added)
+        catalog.upsert(added)
+
+    rebuilt = SongCatalog()
+    rebuilt.upsert(list(by_id.values()))
+    for sort in SONG_SORT_FIELDS:
+        for favorite in (None, True):
+            assert ([record.id for record in catalog.query(sort, True, favorite)]
+                    == [record.id for record in rebuilt.query(sort, True, favorite)])
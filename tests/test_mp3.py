@@ -0,0 +1,70 @@
+import pytest
+
+from server import build_mp3_seek_index, parse_mp3_frame_header
+
+MPEG1_LAYER3_128K_44100 = 0xFFFB9000
+
+
+@pytest.mark.parametrize("header, expected", [
+    (MPEG1_LAYER3_128K_44100, (417, 1152 / 44100)),
+    (MPEG1_LAYER3_128K_44100 | 0x200, (418, 1152 / 44100)),  # padding bit
+    (0xFFFBE400, (960, 1152 / 48000)),  # MPEG-1 Layer III, 320 kbps, 48 kHz
+    (0xFFF38000, (208, 576 / 22050)),  # MPEG-2 Layer III, 64 kbps, 22.05 kHz
+    (0xFFE38000, (417, 576 / 11025)),  # MPEG-2.5 Layer III, 64 kbps, 11.025 kHz
+    (0xFFFD8000, (417, 1152 / 44100)),  # MPEG-1 Layer II, 128 kbps
+    (0xFFFF1000, (32, 384 / 44100)),  # MPEG-1 Layer I, 32 kbps
+])
+def test_valid_frame_headers(header, expected):
+    length, duration = parse_mp3_frame_header(header)
+    assert length == expected[0]
+    assert duration == pytest.approx(expected[1])
+
+
+@pytest.mark.parametrize("header", [
+    0x12345678,  # no frame sync
+    0xFFEB9000,  # reserved version
+    0xFFF99000,  # reserved layer
+    0xFFFB0000,  # free-format bitrate
+    0xFFFBF000,  # invalid bitrate
+    0xFFFB9C00,  # reserved sample rate
+])
+def test_invalid_frame_headers(header):
+    assert parse_mp3_frame_header(header) is None
+
+
+def write_frames(path, count, prefix=b""):
+    frame = MPEG1_LAYER3_128K_44100.to_bytes(4, "big") + bytes(413)
+    path.write_bytes(prefix + frame * count)
+    return len(prefix)
+
+
+def test_seek_index_records_frame_offsets(tmp_path):
+    path = tmp_path / "track.mp3"
+    write_frames(path, 100)
+    offsets = build_mp3_seek_index(str(path), interval=0.5)
+    frame_duration = 1152 / 44100
+    assert offsets[0] == 0
+    assert len(offsets) == int(100 * frame_duration / 0.5) + 1
+    for i, offset in enumerate(offsets):
+        assert offset % 417 == 0
+        # The indexed frame is the one playing at i * interval
+        frame = offset // 417
+        assert frame * frame_duration <= i * 0.5 + 1e-9 < (frame + 1) * frame_duration
+
+
+def test_seek_index_skips_id3_tag_and_resyncs(tmp_path):
+    tag = b"ID3\x04\x00\x00\x00\x00\x00\x14" + bytes(20)
+    path = tmp_path / "tagged.mp3"
+    start = write_frames(path, 40, prefix=tag + b"\x00\xff\x00")
+    offsets = build_mp3_seek_index(str(path), interval=0.5)
+    assert offsets[0] == start
+    assert all((offset - start) % 417 == 0 for offset in offsets)
+
+
+def test_seek_index_of_non_mpeg_data(tmp_path):
+    path = tmp_path / "noise.mp3"
+    path.write_bytes(bytes(4096))
+    assert build_mp3_seek_index(str(path)) is None
+    empty = tmp_path / "empty.mp3"
+    empty.write_bytes(b"")
+    assert build_mp3_seek_index(str(empty)) is None
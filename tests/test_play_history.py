@@ -0,0 +1,86 @@
+import asyncio
+
+import server
+
+
+async def add_songs(db):
+    await db.songs.insert_many([
+        {"id": "song-a", "title": "A", "artist": "Artist A", "duration": 200.0, "file_path": "/music/a.mp3",
+         "play_count": 0},
+        {"id": "song-b", "title": "B", "artist": "Artist B", "duration": 100.0, "file_path": "/music/b.mp3",
+         "play_count": 0},
+    ])
+
+
+async def rollups(collection):
+    return sorted((row["song_id"], row["plays"], row["listening_seconds"])
+                  for row in await collection.find().to_list(None))
+
+
+def record_plays(buffer):
+    for session in ("one", "two", "three"):
+        buffer.record("song-a", session)
+    buffer.record("song-b", "one")
+    # A repeat within the dedup window is not a new play
+    buffer.record("song-b", "one")
+
+
+def test_flush_counts_plays_and_rollups(memory_db):
+    async def scenario():
+        await add_songs(memory_db)
+        buffer = server.play_buffer
+        record_plays(buffer)
+        await buffer.flush()
+
+        songs = {song["id"]: song for song in await memory_db.songs.find().to_list(None)}
+        assert (songs["song-a"]["play_count"], songs["song-b"]["play_count"]) == (3, 1)
+        assert await memory_db.play_events.count_documents({}) == 4
+        expected = [("song-a", 3, 600.0), ("song-b", 1, 100.0)]
+        assert await rollups(memory_db.play_rollups_hourly) == expected
+        assert await rollups(memory_db.play_rollups_daily) == expected
+
+        tracks = (await server.get_top_tracks(limit=10))["tracks"]
+        assert [(track["song"].id, track["plays"]) for track in tracks] == [("song-a", 3), ("song-b", 1)]
+        artists = (await server.get_top_artists(limit=10))["artists"]
+        assert [(artist["artist"], artist["listening_seconds"]) for artist in artists] == [
+            ("Artist A", 600.0), ("Artist B", 100.0)]
+
+    asyncio.run(scenario())
+
+
+def test_retried_history_writes_do_not_double_count(memory_db, monkeypatch):
+    async def scenario():
+        await add_songs(memory_db)
+        buffer = server.play_buffer
+        record_plays(buffer)
+
+        # The daily rollup write fails after the events and the hourly rollups were stored
+        bulk_write = type(memory_db.play_rollups_daily).bulk_write
+        failures = []
+
+        async def fail_daily_once(self, operations, *args, **kwargs):
+            if self.name == "play_rollups_daily" and not failures:
+                failures.append(operations)
+                raise RuntimeError("connection reset")
+            return await bulk_write(self, operations, *args, **kwargs)
+
+        monkeypatch.setattr(type(memory_db.play_rollups_daily), "bulk_write", fail_daily_once)
+        await buffer.flush()
+        assert failures and len(buffer.events) == 4
+        assert await memory_db.play_rollups_daily.count_documents({}) == 0
+
+        buffer.record("song-b", "two")
+        await buffer.flush()
+        await buffer.flush()
+        assert not buffer.events
+        expected = [("song-a", 3, 600.0), ("song-b", 2, 200.0)]
+        assert await memory_db.play_events.count_documents({}) == 5
+        assert await rollups(memory_db.play_rollups_hourly) == expected
+        assert await rollups(memory_db.play_rollups_daily) == expected
+
+        # Replaying already stored events changes nothing
+        await buffer.write_history(await memory_db.play_events.find().to_list(None))
+        assert await rollups(memory_db.play_rollups_hourly) == expected
+        assert await rollups(memory_db.play_rollups_daily) == expected
+
+    asyncio.run(scenario())
@@ -0,0 +1,86 @@
+import asyncio
+
+import server
+
+
+async def add_songs(db, count):
+    await db.songs.insert_many([
+        {"id": f"song-{i}", "title": f"Song {i}", "file_path": "/music/x.mp3"} for i in range(count)
+    ])
+
+
+def test_playlist_etag_ignores_other_library_changes(api, memory_db):
+    async def scenario():
+        await add_songs(memory_db, 2)
+        async with api() as client:
+            playlist = (await client.post("/api/playlists", json={"name": "Mix"})).json()
+            response = await client.get("/api/playlists")
+            etag = response.headers["etag"]
+
+            # A play flush moves the library version but leaves playlists alone
+            server.play_buffer.record("song-0", "session")
+            await server.play_buffer.flush()
+            assert (await client.get("/api/songs/song-0")).json()["play_count"] == 1
+            response = await client.get("/api/playlists", headers={"If-None-Match": etag})
+            assert response.status_code == 304
+
+            await client.put(f"/api/playlists/{playlist['id']}/songs/song-1")
+            response = await client.get("/api/playlists", headers={"If-None-Match": etag})
+            assert response.status_code == 200
+            assert response.headers["etag"] != etag
+            assert response.json()[0]["song_ids"] == ["song-1"]
+
+    asyncio.run(scenario())
+
+
+def test_songs_are_spliced_in_at_a_position(api, memory_db):
+    async def scenario():
+        await add_songs(memory_db, 6)
+        async with api() as client:
+            playlist_id = (await client.post("/api/playlists", json={"name": "Mix"})).json()["id"]
+            url = f"/api/playlists/{playlist_id}/songs"
+            response = await client.post(url, json={"song_ids": ["song-0", "song-1", "song-2"]})
+            assert response.json() == {"added": ["song-0", "song-1", "song-2"], "missing": []}
+
+            # Ids already present are skipped, unknown ids are reported, the rest land at position 1
+            response = await client.post(url, json={
+                "song_ids": ["song-4", "song-2", "nope", "song-3", "song-4"], "position": 1
+            })
+            assert response.json() == {"added": ["song-4", "song-2", "song-3"], "missing": ["nope"]}
+            page = (await client.get(url)).json()
+            assert [song["id"] for song in page["songs"]] == ["song-0", "song-4", "song-3", "song-1", "song-2"]
+
+            await client.post(url, json={"song_ids": ["song-5"], "position": 0})
+            page = (await client.get(url, params={"skip": 1, "limit": 3})).json()
+            assert page["total"] == 6
+            assert [song["id"] for song in page["songs"]] == ["song-0", "song-4", "song-3"]
+
+            response = await client.post("/api/playlists/nope/songs", json={"song_ids": ["song-0"]})
+            assert response.status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_reorder_requires_the_current_songs(api, memory_db):
+    async def scenario():
+        await add_songs(memory_db, 3)
+        async with api() as client:
+            playlist_id = (await client.post("/api/playlists", json={"name": "Mix"})).json()["id"]
+            url = f"/api/playlists/{playlist_id}/songs"
+            await client.post(url, json={"song_ids": ["song-0", "song-1", "song-2"]})
+
+            response = await client.put(url, json={"song_ids": ["song-2", "song-0", "song-1"]})
+            assert response.status_code == 200
+            assert [song["id"] for song in (await client.get(url)).json()["songs"]] == ["song-2", "song-0", "song-1"]
+
+            # A stale client that missed a removal must not bring the song back
+            await client.request("DELETE", url, json={"song_ids": ["song-1"]})
+            response = await client.put(url, json={"song_ids": ["song-1", "song-0", "song-2"]})
+            assert response.status_code == 409
+            response = await client.put(url, json={"song_ids": ["song-0", "song-0"]})
+            assert response.status_code == 400
+            assert [song["id"] for song in (await client.get(url)).json()["songs"]] == ["song-2", "song-0"]
+
+            assert (await client.put("/api/playlists/nope/songs", json={"song_ids": []})).status_code == 404
+
+    asyncio.run(scenario())
@@ -0,0 +1,160 @@
+import asyncio
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from server import FileRangeResponse, parse_range_header
+
+SIZE = 1000
+
+
+def test_missing_header_is_ignored():
+    assert parse_range_header(None, SIZE) is None
+    assert parse_range_header("", SIZE) is None
+
+
+@pytest.mark.parametrize("header", [
+    "items=0-10",
+    "bytes=",
+    "bytes=abc",
+    "bytes=5",
+    "bytes=-",
+    "bytes=10-5",
+    "bytes=1-2-3",
+    "bytes=0x10-20",
+    "bytes=" + ",".join(f"{i * 10}-{i * 10}" for i in range(17)),
+])
+def test_malformed_headers_are_ignored(header):
+    assert parse_range_header(header, SIZE) is None
+
+
+def test_single_ranges():
+    assert parse_range_header("bytes=0-99", SIZE) == [(0, 99)]
+    assert parse_range_header("bytes=500-", SIZE) == [(500, 999)]
+    assert parse_range_header("bytes=900-5000", SIZE) == [(900, 999)]
+    assert parse_range_header(" Bytes = 10 - 20 ", SIZE) == [(10, 20)]
+
+
+def test_suffix_ranges():
+    assert parse_range_header("bytes=-100", SIZE) == [(900, 999)]
+    assert parse_range_header("bytes=-5000", SIZE) == [(0, 999)]
+
+
+def test_overlapping_and_adjacent_ranges_are_merged():
+    assert parse_range_header("bytes=50-99,0-49", SIZE) == [(0, 99)]
+    assert parse_range_header("bytes=0-10,5-20,-10", SIZE) == [(0, 20), (990, 999)]
+    assert parse_range_header("bytes=0-1,3-4", SIZE) == [(0, 1), (3, 4)]
+
+
+def test_unsatisfiable_ranges_raise_416():
+    for header in ("bytes=1000-", "bytes=2000-3000", "bytes=-0", "bytes=1000-1001,-0"):
+        with pytest.raises(HTTPException) as excinfo:
+            parse_range_header(header, SIZE)
+        assert excinfo.value.status_code == 416
+        assert excinfo.value.headers["Content-Range"] == f"bytes */{SIZE}"
+
+
+def test_unsatisfiable_parts_are_dropped():
+    assert parse_range_header("bytes=2000-3000,0-9", SIZE) == [(0, 9)]
+
+
+@pytest.fixture
+def audio_file(tmp_path):
+    data = os.urandom(SIZE)
+    path = tmp_path / "track.mp3"
+    path.write_bytes(data)
+    return path, data
+
+
+def serve(response, method="GET", zerocopy=False):
+    """Drive a response as an ASGI app; returns (status, headers, body)"""
+    messages = []
+
+    async def send(message):
+        if message["type"] == "http.response.zerocopysend":
+            # Read while the response still holds the file open, as a server would
+            data = os.pread(message["file"].fileno(), message["count"], message["offset"])
+            message = {"type": "http.response.body", "body": data, "zerocopy": True}
+        messages.append(message)
+
+    scope = {"type": "http", "method": method}
+    if zerocopy:
+        scope["extensions"] = {"http.response.zerocopysend": {}}
+    asyncio.run(response(scope, None, send))
+    start = messages[0]
+    headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], headers, body, messages
+
+
+def test_full_response(audio_file):
+    path, data = audio_file
+    status, headers, body, _ = serve(FileRangeResponse(path, SIZE, media_type="audio/mpeg"))
+    assert status == 200
+    assert headers["accept-ranges"] == "bytes"
+    assert headers["content-length"] == str(SIZE)
+    assert body == data
+
+
+def test_single_range_response(audio_file):
+    path, data = audio_file
+    status, headers, body, _ = serve(FileRangeResponse(path, SIZE, [(100, 199)], media_type="audio/mpeg"))
+    assert status == 206
+    assert headers["content-range"] == f"bytes 100-199/{SIZE}"
+    assert headers["content-length"] == "100"
+    assert body == data[100:200]
+
+
+def test_multipart_byteranges_framing(audio_file):
+    path, data = audio_file
+    response = FileRangeResponse(path, SIZE, [(0, 4), (990, 999)], media_type="audio/mpeg")
+    status, headers, body, _ = serve(response)
+    assert status == 206
+    assert headers["content-type"].startswith("multipart/byteranges; boundary=")
+    boundary = headers["content-type"].split("boundary=")[1]
+    expected = (
+        f"--{boundary}\r\nContent-Type: audio/mpeg\r\nContent-Range: bytes 0-4/{SIZE}\r\n\r\n".encode()
+        + data[0:5]
+        + f"\r\n--{boundary}\r\nContent-Type: audio/mpeg\r\nContent-Range: bytes 990-999/{SIZE}\r\n\r\n".encode()
+        + data[990:1000]
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    assert body == expected
+    assert headers["content-length"] == str(len(expected))
+    assert "content-range" not in headers
+
+
+def test_offset_makes_ranges_relative_to_the_seek_point(audio_file):
+    path, data = audio_file
+    status, headers, body, _ = serve(FileRangeResponse(path, SIZE, offset=400))
+    assert (status, body) == (200, data[400:])
+
+    status, headers, body, _ = serve(FileRangeResponse(path, SIZE, [(10, 19)], offset=400))
+    assert status == 206
+    assert headers["content-range"] == f"bytes 10-19/{SIZE - 400}"
+    assert body == data[410:420]
+
+
+def test_head_sends_headers_only(audio_file):
+    path, _ = audio_file
+    status, headers, body, _ = serve(FileRangeResponse(path, SIZE, [(0, 9)]), method="HEAD")
+    assert (status, headers["content-length"], body) == (206, "10", b"")
+
+
+def test_zerocopy_send_when_the_server_advertises_it(audio_file):
+    path, data = audio_file
+    _, _, body, messages = serve(FileRangeResponse(path, SIZE, [(0, 4), (500, 599)]), zerocopy=True)
+    assert [message.get("body") for message in messages if message.get("zerocopy")] == [data[0:5], data[500:600]]
+    assert data[0:5] in body and data[500:600] in body
+
+
+def test_cached_blocks_serve_the_same_bytes(audio_file, monkeypatch):
+    import server
+
+    path, data = audio_file
+    monkeypatch.setattr(server, "audio_cache", server.AudioBlockCache(1 << 20, 256))
+    for _ in range(3):
+        _, _, body, _ = serve(FileRangeResponse(path, SIZE, [(200, 700)], cache_key="track"))
+        assert body == data[200:701]
+    assert server.audio_cache.current_bytes > 0
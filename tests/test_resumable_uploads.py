@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+from datetime import datetime, timedelta
+
+import server
+
+
+async def start(client, data, filename="long.wav"):
+    response = await client.post("/api/uploads", json={
+        "filename": filename, "content_type": "audio/wav", "length": len(data)
+    })
+    assert response.status_code == 201
+    assert response.headers["upload-offset"] == "0"
+    return response.json()["id"]
+
+
+async def put(client, session_id, offset, chunk):
+    return await client.put(f"/api/uploads/{session_id}", content=chunk, headers={"Upload-Offset": str(offset)})
+
+
+def test_upload_resumes_from_the_received_offset(api, storage, make_wav):
+    async def scenario():
+        data = make_wav(2)
+        async with api() as client:
+            session_id = await start(client, data)
+            response = await put(client, session_id, 0, data[:30000])
+            assert response.status_code == 204 and response.headers["upload-offset"] == "30000"
+
+            # The client lost track of the offset: replaying the chunk is refused with the real one
+            response = await put(client, session_id, 0, data[:30000])
+            assert response.status_code == 409 and response.headers["upload-offset"] == "30000"
+            response = await client.post(f"/api/uploads/{session_id}/finalize")
+            assert response.status_code == 409 and response.headers["upload-offset"] == "30000"
+
+            status = (await client.get(f"/api/uploads/{session_id}")).json()
+            assert (status["offset"], status["length"]) == (30000, len(data))
+            response = await put(client, session_id, status["offset"], data[status["offset"]:])
+            assert response.headers["upload-offset"] == str(len(data))
+
+            song = (await client.post(f"/api/uploads/{session_id}/finalize")).json()
+            assert song["title"] == "long"
+            assert song["content_hash"] == hashlib.sha256(data).hexdigest()
+            assert (storage / "upload_dir" / f"{song['content_hash']}.wav").read_bytes() == data
+            assert (await client.get(f"/api/uploads/{session_id}")).status_code == 404
+        assert not server.upload_session_path(session_id).exists()
+        assert await server.db.songs.count_documents({}) == 1
+
+    asyncio.run(scenario())
+
+
+def test_chunks_past_the_declared_length_are_refused(api, storage, make_wav):
+    async def scenario():
+        data = make_wav()
+        async with api() as client:
+            session_id = await start(client, data)
+            response = await put(client, session_id, 0, data + b"extra")
+            assert response.status_code == 413
+            # The body arrived as one piece, so none of it was kept
+            assert (await client.get(f"/api/uploads/{session_id}")).json()["offset"] == 0
+            assert (await put(client, session_id, 0, data)).status_code == 204
+            assert (await client.post(f"/api/uploads/{session_id}/finalize")).status_code == 200
+
+    asyncio.run(scenario())
+
+
+def test_a_session_takes_one_request_at_a_time(api, storage, make_wav):
+    async def scenario():
+        data = make_wav()
+        async with api() as client:
+            session_id = await start(client, data)
+            server.uploads_in_progress.add(session_id)
+            try:
+                assert (await put(client, session_id, 0, data)).status_code == 409
+                assert (await client.post(f"/api/uploads/{session_id}/finalize")).status_code == 409
+                assert (await client.delete(f"/api/uploads/{session_id}")).status_code == 409
+            finally:
+                server.uploads_in_progress.discard(session_id)
+            assert (await put(client, session_id, 0, data)).status_code == 204
+
+    asyncio.run(scenario())
+
+
+def test_aborted_and_expired_sessions_are_gone(api, storage, make_wav):
+    async def scenario():
+        data = make_wav()
+        async with api() as client:
+            aborted = await start(client, data)
+            await put(client, aborted, 0, data[:100])
+            assert (await client.delete(f"/api/uploads/{aborted}")).status_code == 200
+            assert not server.upload_session_path(aborted).exists()
+            assert (await client.get(f"/api/uploads/{aborted}")).status_code == 404
+
+            expired = await start(client, data)
+            await server.db.upload_sessions.update_one(
+                {"id": expired}, {"$set": {"expires_at": datetime.utcnow() - timedelta(seconds=1)}})
+            assert (await put(client, expired, 0, data)).status_code == 404
+            assert (await client.post(f"/api/uploads/{expired}/finalize")).status_code == 404
+
+    asyncio.run(scenario())
+
+
+def test_oversized_sessions_are_refused(api, storage, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_SIZE", 1000)
+
+    async def scenario():
+        async with api() as client:
+            response = await client.post("/api/uploads", json={
+                "filename": "big.wav", "content_type": "audio/wav", "length": 1001
+            })
+            assert response.status_code == 413
+            response = await client.post("/api/uploads", json={
+                "filename": "notes.txt", "content_type": "text/plain", "length": 10
+            })
+            assert response.status_code == 400
+
+    asyncio.run(scenario())
@@ -0,0 +1,95 @@
+import asyncio
+import os
+
+import pytest
+from mutagen.id3 import TALB, TPE1, TIT2
+from mutagen.wave import WAVE
+
+import server
+
+
+@pytest.fixture
+def library(memory_db, storage, monkeypatch):
+    directory = storage / "library"
+    directory.mkdir()
+    monkeypatch.setattr(server, "LIBRARY_DIRS", [directory])
+    return directory
+
+
+def write_track(path, data, title, album="Album", mtime=None):
+    path.write_bytes(data)
+    tags = WAVE(path)
+    tags.add_tags()
+    tags.tags.add(TIT2(text=[title]))
+    tags.tags.add(TPE1(text=["Artist"]))
+    tags.tags.add(TALB(text=[album]))
+    tags.save()
+    if mtime:
+        os.utime(path, (mtime, mtime))
+
+
+async def songs_by_title():
+    return {song["title"]: song async for song in server.db.songs.find({}, {"_id": 0})}
+
+
+async def analyze_all():
+    for song in (await songs_by_title()).values():
+        await server.analyze_loudness(song["file_path"], song["content_hash"])
+    return await songs_by_title()
+
+
+def test_scan_adds_updates_and_removes_files(library, make_wav):
+    async def scenario():
+        write_track(library / "a.wav", make_wav(), "A")
+        write_track(library / "b.wav", make_wav(), "B")
+        await server.scan_library()
+        assert {key: server.scan_status[key] for key in ("added", "updated", "removed")} == {
+            "added": 2, "updated": 0, "removed": 0}
+        before = await songs_by_title()
+
+        await server.scan_library()
+        assert server.scan_status["unchanged"] == 2
+
+        write_track(library / "a.wav", make_wav(2), "A2", mtime=1_000_000)
+        (library / "b.wav").unlink()
+        await server.scan_library()
+        assert {key: server.scan_status[key] for key in ("added", "updated", "removed")} == {
+            "added": 0, "updated": 1, "removed": 1}
+        after = await songs_by_title()
+        assert list(after) == ["A2"]
+        assert after["A2"]["id"] == before["A"]["id"]
+        assert after["A2"]["content_hash"] != before["A"]["content_hash"]
+        assert [record.id for record in server.song_catalog.query("title", False)] == [after["A2"]["id"]]
+
+    asyncio.run(scenario())
+
+
+def test_rescanned_files_lose_their_stale_gains(library, make_wav):
+    async def scenario():
+        write_track(library / "loud.wav", make_wav(3, amplitude=16000), "Loud")
+        write_track(library / "other.wav", make_wav(3, amplitude=4000), "Other")
+        await server.scan_library()
+        analyzed = await analyze_all()
+        assert analyzed["Loud"]["track_gain"] < analyzed["Other"]["track_gain"]
+        album_gain = analyzed["Other"]["album_gain"]
+        assert album_gain is not None
+
+        # Replace the loud file with a much quieter one and move it to another album
+        write_track(library / "loud.wav", make_wav(3, amplitude=800), "Quiet", album="Elsewhere",
+                    mtime=1_000_000)
+        await server.scan_library()
+        rescanned = await songs_by_title()
+        quiet, other = rescanned["Quiet"], rescanned["Other"]
+        assert (quiet["track_gain"], quiet["track_peak"], quiet["album_gain"], quiet["album_peak"]) == (
+            None, None, None, None)
+        # The album it left is measured over its remaining track only
+        assert other["album_gain"] == pytest.approx(other["track_gain"])
+        assert other["album_gain"] != album_gain
+
+        assert await server.analyze_library_loudness() == {"queued": 1}
+        await asyncio.gather(*server.background_tasks)
+        quiet = (await songs_by_title())["Quiet"]
+        assert quiet["track_gain"] > analyzed["Loud"]["track_gain"] + 20
+        assert quiet["album_gain"] == pytest.approx(quiet["track_gain"])
+
+    asyncio.run(scenario())
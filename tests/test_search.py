@@ -0,0 +1,72 @@
+from server import SearchIndex, normalize_text, text_trigrams
+
+
+def build_index():
+    index = SearchIndex()
+    for song in [
+        {"id": "1", "title": "Bohemian Rhapsody", "artist": "Queen", "album": "A Night at the Opera"},
+        {"id": "2", "title": "Rhapsody in Blue", "artist": "George Gershwin", "album": "Gershwin Classics"},
+        {"id": "3", "title": "Killer Queen", "artist": "Queen", "album": "Sheer Heart Attack"},
+        {"id": "4", "title": "Café del Mar", "artist": "Energy 52", "album": "Café del Mar"},
+        {"id": "5", "title": "Queen of the Night", "artist": "Whitney Houston", "album": "The Bodyguard"},
+    ]:
+        index.add(song)
+    return index
+
+
+def ids(results):
+    return [song_id for song_id, _ in results]
+
+
+def test_normalize_text_folds_case_accents_and_punctuation():
+    assert normalize_text("  Café—Del  MAR! ") == "cafe del mar"
+    assert normalize_text(None) == ""
+
+
+def test_prefix_trigrams_leave_the_last_word_open():
+    assert "ee " in text_trigrams("quee")
+    assert "ee " not in text_trigrams("quee", prefix=True)
+    assert text_trigrams("quee", prefix=True) <= text_trigrams("queen")
+
+
+def test_exact_title_ranks_first():
+    assert ids(build_index().search("killer queen"))[0] == "3"
+
+
+def test_title_matches_outrank_artist_matches():
+    results = ids(build_index().search("queen"))
+    assert set(results[:3]) == {"1", "3", "5"}
+    assert results.index("5") < results.index("1")
+
+
+def test_prefix_typing_and_accents():
+    index = build_index()
+    assert ids(index.search("rhaps"))[:2] in (["1", "2"], ["2", "1"])
+    assert ids(index.search("cafe"))[0] == "4"
+    assert ids(index.search("CAFÉ DEL"))[0] == "4"
+
+
+def test_tolerates_a_typo():
+    assert "3" in ids(build_index().search("killr queen"))
+
+
+def test_no_match_and_empty_query():
+    index = build_index()
+    assert index.search("zzzzzz") == []
+    assert index.search("!!") == []
+
+
+def test_limit():
+    assert len(build_index().search("queen", limit=2)) == 2
+
+
+def test_update_and_remove():
+    index = build_index()
+    index.add({"id": "3", "title": "Somebody to Love", "artist": "Queen", "album": "A Day at the Races"})
+    assert "3" not in ids(index.search("killer"))
+    assert ids(index.search("somebody"))[0] == "3"
+
+    index.remove("3")
+    index.remove("missing")
+    assert "3" not in ids(index.search("queen"))
+    assert all("3" not in posting for posting in index.postings.values())
@@ -0,0 +1,30 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+
+
+def test_refresh_counts_recent_plays_outside_the_facet(memory_db):
+    async def scenario():
+        now = datetime.utcnow()
+        await memory_db.songs.insert_many([
+            {"id": f"song-{i}", "title": f"Song {i}", "file_path": "/music/x.mp3", "play_count": i,
+             "is_favorite": i % 3 == 0, "last_played": now - timedelta(days=i) if i % 2 else None}
+            for i in range(20)
+        ])
+        snapshot = server.StatsSnapshot(60)
+        stats = await snapshot.get()
+        assert stats["total_songs"] == 20
+        assert stats["favorites"] == 7
+        # Odd songs played 1, 3 and 5 days ago fall inside the 7-day window
+        assert stats["recent_plays"] == 3
+        assert [song.id for song in stats["most_played"]][:2] == ["song-19", "song-18"]
+
+        played = await memory_db.songs.find({"id": {"$in": ["song-1", "song-2"]}}, {"_id": 0}).to_list(None)
+        snapshot.plays_recorded([{**song, "play_count": song["play_count"] + 30, "last_played": now}
+                                 for song in played])
+        stats = await snapshot.get()
+        assert stats["recent_plays"] == 4
+        assert [song.id for song in stats["most_played"]][:2] == ["song-2", "song-1"]
+
+    asyncio.run(scenario())
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+BOUNDARY = "----upload-boundary"
+
+
+def multipart(*parts):
+    """Encode (name, filename, content_type, data) parts as a multipart/form-data body"""
+    body = b""
+    for name, filename, content_type, data in parts:
+        disposition = f'form-data; name="{name}"' + (f'; filename="{filename}"' if filename else "")
+        body += f"--{BOUNDARY}\r\nContent-Disposition: {disposition}\r\n".encode()
+        if content_type:
+            body += f"Content-Type: {content_type}\r\n".encode()
+        body += b"\r\n" + data + b"\r\n"
+    return body + f"--{BOUNDARY}--\r\n".encode()
+
+
+def streaming_request(body, chunk_size=65536, content_length=None,
+                      content_type=f"multipart/form-data; boundary={BOUNDARY}"):
+    """A request whose body arrives in ``chunk_size`` pieces"""
+    chunks = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)] or [b""]
+    received = []
+
+    async def receive():
+        chunk = chunks[len(received)]
+        received.append(chunk)
+        return {"type": "http.request", "body": chunk, "more_body": len(received) < len(chunks)}
+
+    headers = [(b"content-type", content_type.encode())]
+    if content_length is not None:
+        headers.append((b"content-length", str(content_length).encode()))
+    request = Request({"type": "http", "method": "POST", "path": "/", "headers": headers}, receive)
+    return request, received
+
+
+def staged_files(storage):
+    return list((storage / "upload_dir").iterdir())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 65536])
+def test_files_are_staged_whatever_the_chunking(storage, chunk_size):
+    first, second = b"\x00\r\n--" * 300, bytes(range(256)) * 10
+    body = multipart(
+        ("note", None, None, b"not a file"),
+        ("files", "a.mp3", "audio/mpeg", first),
+        ("other", "c.mp3", "audio/mpeg", b"wrong field"),
+        ("files", "b.wav", "audio/wav", second),
+    )
+    request, _ = streaming_request(body, chunk_size)
+    parts = asyncio.run(server.receive_uploads(request, "files"))
+
+    assert [(part["filename"], part["content_type"], part["size"]) for part in parts] == [
+        ("a.mp3", "audio/mpeg", len(first)), ("b.wav", "audio/wav", len(second))]
+    for part, data in zip(parts, (first, second)):
+        assert part["hash"] == hashlib.sha256(data).hexdigest()
+        assert part["path"].read_bytes() == data
+    assert sorted(staged_files(storage)) == sorted(part["path"] for part in parts)
+
+
+def test_oversized_and_non_audio_files_are_rejected_individually(storage, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_SIZE", 1000)
+    body = multipart(
+        ("files", "big.mp3", "audio/mpeg", b"x" * 1001),
+        ("files", "notes.txt", "text/plain", b"hello"),
+        ("files", "ok.mp3", "audio/mpeg", b"y" * 1000),
+    )
+    request, _ = streaming_request(body, 64)
+    big, text, ok = asyncio.run(server.receive_uploads(request, "files"))
+
+    assert (big["status_code"], "path" in big) == (413, False)
+    assert (text["status_code"], "path" in text) == (400, False)
+    assert ok["size"] == 1000 and "error" not in ok
+    assert staged_files(storage) == [ok["path"]]
+
+
+def test_single_upload_stops_at_the_size_limit(storage, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_SIZE", 1000)
+    body = multipart(("file", "big.mp3", "audio/mpeg", b"x" * 100_000))
+    request, received = streaming_request(body, 100)
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(server.receive_uploads(request, "file", single=True))
+    assert excinfo.value.status_code == 413
+    # Rejected while the body was still arriving
+    assert sum(map(len, received)) < 2000
+    assert staged_files(storage) == []
+
+
+def test_single_upload_checks_content_length_first(storage, monkeypatch):
+    monkeypatch.setattr(server, "MAX_UPLOAD_SIZE", 1000)
+    body = multipart(("file", "big.mp3", "audio/mpeg", b"x" * 100_000))
+    request, received = streaming_request(body, content_length=len(body))
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(server.receive_uploads(request, "file", single=True))
+    assert excinfo.value.status_code == 413
+    assert received == []
+
+
+def test_truncated_body_leaves_nothing_staged(storage):
+    body = multipart(("files", "a.mp3", "audio/mpeg", b"a" * 500), ("files", "b.mp3", "audio/mpeg", b"b" * 500))
+    request, _ = streaming_request(body[:800], 50)
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(server.receive_uploads(request, "files"))
+    assert excinfo.value.status_code == 400
+    assert staged_files(storage) == []
+
+
+@pytest.mark.parametrize("content_type, body, field", [
+    ("application/octet-stream", b"raw", "file"),
+    (f"multipart/form-data; boundary={BOUNDARY}", multipart(("other", "a.mp3", "audio/mpeg", b"a")), "file"),
+])
+def test_requests_without_a_file_are_a_400(storage, content_type, body, field):
+    request, _ = streaming_request(body, content_type=content_type)
+    with pytest.raises(HTTPException) as excinfo:
+        asyncio.run(server.receive_uploads(request, field, single=True))
+    assert excinfo.value.status_code == 400